@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Benchmark offline della pipeline di selezione (gather -> enrich/rank -> refresh -> caption)
+Uso:
+  python bench_pipeline.py record [--dir replay_fixtures]
+      esegue la pipeline con PA-API, Keepa e Upstash reali e salva le
+      risposte (Telegram è sempre finto: non pubblica nulla)
+  python bench_pipeline.py replay [--dir replay_fixtures] [--latency]
+      riesegue la pipeline sulle risposte salvate, senza rete; con --latency
+      reintroduce le durate registrate delle chiamate PA-API e Keepa
+
+Per ogni fase stampa tempo, chiamate esterne per servizio e picco di memoria.
+Un replay per processo: cache L1, indice categorie e rate limiter sono
+stato del processo.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+def _install_record(path):
+    from config import KEEPA_TOKENS_PER_ASIN
+    from helpers import amazon, keepa_new, redis_store, replay
+
+    paapi = replay.PaapiRecorder(amazon._search_items, amazon._get_items)
+    amazon._search_items = paapi.search_items
+    amazon._get_items = paapi.get_items
+
+    keepa = replay.KeepaRecorder(keepa_new.get_client(), KEEPA_TOKENS_PER_ASIN)
+    keepa_new._client = keepa
+
+    real = redis_store.get_client()
+    redis = replay.RedisRecorder(real) if real else None
+    if redis:
+        redis_store._client = redis
+    else:
+        print("⚠️  Upstash non configurato: il replay partirà da una cache vuota")
+
+    def _dump():
+        os.makedirs(path, exist_ok=True)
+        paapi.dump(path)
+        keepa.dump(path)
+        (redis or replay.RedisRecorder(None)).dump(path)
+        print(f"✅ Fixture salvate in {path}/")
+    return _dump
+
+def _install_replay(path, latency):
+    from config import KEEPA_TOKENS_PER_ASIN
+    from helpers import amazon, keepa_new, redis_store, replay
+
+    paapi = replay.PaapiReplay(path, latency)
+    amazon._client = lambda: None
+    if not latency:
+        # le attese del rate limiter non sono costo della pipeline
+        amazon._limiter = replay.NoLimiter()
+    amazon._search_items = paapi.search_items
+    amazon._get_items = paapi.get_items
+
+    keepa = replay.KeepaReplay(path, KEEPA_TOKENS_PER_ASIN, latency)
+    keepa_new._client = keepa
+
+    redis_store._client = replay.redis_from_log(path)
+    redis_store._client_ready = True
+
+    def _report():
+        if paapi.unrecorded or keepa.unrecorded:
+            print(f"⚠️  Richieste non registrate: PA-API {paapi.unrecorded}, Keepa {keepa.unrecorded} ASIN "
+                  f"(registra di nuovo se la pipeline chiede dati diversi)")
+    return _report
+
+def _stage(results, name, fn):
+    from helpers import replay
+
+    before = Counter(replay.calls)
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    out = fn()
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    results.append((name, wall, replay.calls - before, peak))
+    return out
+
+def run_pipeline():
+    from config import POSTS_PER_SLOT, AMAZON_PARTNER_TAG, CHANNEL_MAIN
+    from helpers.formatter import format_caption
+    from helpers.replay import FakeTelegram
+    from helpers.selector import gather_candidates, enrich_and_rank, refresh_offers
+
+    telegram = FakeTelegram()
+    results = []
+    cands = _stage(results, "gather_candidates", gather_candidates)
+    ranked = _stage(results, "enrich_and_rank", lambda: enrich_and_rank(cands, POSTS_PER_SLOT))
+    to_post = _stage(results, "refresh_offers", lambda: refresh_offers(ranked[:POSTS_PER_SLOT]))
+
+    async def _publish():
+        for offer in to_post:
+            await telegram.send_message(CHANNEL_MAIN, format_caption(offer, AMAZON_PARTNER_TAG))
+
+    _stage(results, "format_caption", lambda: asyncio.run(_publish()))
+    return results, len(cands), len(ranked)
+
+def print_report(results, n_cands, n_ranked):
+    services = ["paapi", "keepa", "redis", "telegram"]
+    print("\n=== BENCHMARK ===")
+    print(f"{'fase':<20}{'tempo s':>10}" + "".join(f"{s:>10}" for s in services) + f"{'picco MB':>10}")
+    total = Counter()
+    for name, wall, calls, peak in results:
+        total.update(calls)
+        print(f"{name:<20}{wall:>10.3f}" + "".join(f"{calls.get(s, 0):>10}" for s in services) + f"{peak / 2**20:>10.2f}")
+    print(f"{'totale':<20}{sum(r[1] for r in results):>10.3f}" + "".join(f"{total.get(s, 0):>10}" for s in services))
+    print(f"Candidati: {n_cands}, in classifica: {n_ranked}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Record/replay e benchmark della pipeline di selezione")
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("--dir", default="replay_fixtures")
+    parser.add_argument("--latency", action="store_true", help="replay con le durate registrate delle chiamate")
+    args = parser.parse_args()
+
+    if args.mode == "replay":
+        # Nessuna rete: basta che Keepa risulti attivo perché la pipeline lo usi
+        os.environ.setdefault("API_ID", "0")
+        os.environ.setdefault("KEEPA_API_KEY", "replay")
+        os.environ["USE_KEEPA"] = "true"
+        if not os.path.isdir(args.dir):
+            print(f"❌ Fixture non trovate in {args.dir}/: esegui prima `python bench_pipeline.py record`")
+            return 1
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    tracemalloc.start()
+    finish = _install_record(args.dir) if args.mode == "record" else _install_replay(args.dir, args.latency)
+    results, n_cands, n_ranked = run_pipeline()
+    finish()
+    print_report(results, n_cands, n_ranked)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
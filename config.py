@@ -15,28 +15,54 @@ AMAZON_SECRET_KEY = os.getenv("AMAZON_SECRET_KEY")
 AMAZON_PARTNER_TAG = os.getenv("AMAZON_PARTNER_TAG", "brislydeals-21")
 AMAZON_HOST = os.getenv("AMAZON_HOST", "webservices.amazon.it")
 AMAZON_REGION = os.getenv("AMAZON_REGION", "eu-west-1")
-AMZ_THROTTLE_MS = int(os.getenv("AMZ_THROTTLE_MS", "1200"))
+AMZ_TPS = float(os.getenv("AMZ_TPS", "1.0"))          # richieste/secondo consentite da PA-API
+AMZ_TPS_MIN = float(os.getenv("AMZ_TPS_MIN", "0.2"))  # rate minimo dopo TooManyRequests
+AMZ_MAX_RETRIES = int(os.getenv("AMZ_MAX_RETRIES", "2"))
 
 # Keepa
 KEEPA_API_KEY = os.getenv("KEEPA_API_KEY")
 USE_KEEPA = os.getenv("USE_KEEPA", "true").lower() == "true"
-KEEPA_TTL_HOURS = int(os.getenv("KEEPA_TTL_HOURS", "12"))
+KEEPA_TTL_HOURS = int(os.getenv("KEEPA_TTL_HOURS", "12"))          # TTL per prezzi a volatilità media/ignota
+KEEPA_TTL_MIN_HOURS = int(os.getenv("KEEPA_TTL_MIN_HOURS", "2"))   # prezzi volatili e deal
+KEEPA_TTL_MAX_HOURS = int(os.getenv("KEEPA_TTL_MAX_HOURS", "48"))  # prezzi stabili
+KEEPA_NEG_TTL_HOURS = int(os.getenv("KEEPA_NEG_TTL_HOURS", "6"))        # ASIN senza prodotto/stats
+KEEPA_NEG_ERROR_MIN = int(os.getenv("KEEPA_NEG_ERROR_MIN", "15"))       # primo backoff dopo un errore
+KEEPA_NEG_ERROR_MAX_MIN = int(os.getenv("KEEPA_NEG_ERROR_MAX_MIN", "360"))
+CATEGORY_INDEX_DAYS = int(os.getenv("CATEGORY_INDEX_DAYS", "7"))  # refresh indice categorie radice (1 token Keepa)
+PRICE_HISTORY_DAYS = int(os.getenv("PRICE_HISTORY_DAYS", "180"))  # storico prezzi locale conservato per ASIN
+PRICE_HISTORY_FILE = os.getenv("PRICE_HISTORY_FILE")  # file locale per lo storico prezzi senza Upstash (opzionale)
 KEEPA_DOMAIN = os.getenv("KEEPA_DOMAIN", "IT")
-KEEPA_MAX_ENRICH = int(os.getenv("KEEPA_MAX_ENRICH", "8"))  # quante offerte Amazon arricchire/slot
+KEEPA_MAX_ENRICH = int(os.getenv("KEEPA_MAX_ENRICH", "8"))  # offerte Amazon da arricchire/slot se il saldo token non è noto
+KEEPA_TOKENS_PER_ASIN = int(os.getenv("KEEPA_TOKENS_PER_ASIN", "4"))  # 1 base + buybox 2 + rating 1
+KEEPA_TOKEN_RESERVE = int(os.getenv("KEEPA_TOKEN_RESERVE", "0"))      # token da non spendere mai
+KEEPA_NONBLOCKING = os.getenv("KEEPA_NONBLOCKING", "true").lower() == "true"  # mai aspettare la ricarica token: rimanda gli ASIN al run successivo
+KEEPA_MIGRATE_LEGACY = os.getenv("KEEPA_MIGRATE_LEGACY", "false").lower() == "true"  # migra le voci keepa_fixed: (solo il primo giorno dopo l'aggiornamento)
 
 # Upstash
 UPSTASH_REDIS_URL = os.getenv("UPSTASH_REDIS_URL")
 UPSTASH_REDIS_TOKEN = os.getenv("UPSTASH_REDIS_TOKEN")
+CACHE_L1_SIZE = int(os.getenv("CACHE_L1_SIZE", "2048"))  # chiavi max nella cache in memoria
 
 # Regole
 MIN_STARS = float(os.getenv("MIN_STARS", "4.0"))
 MIN_DISCOUNT = int(os.getenv("MIN_DISCOUNT", "20"))
 DEDUP_DAYS = int(os.getenv("DEDUP_DAYS", "4"))
+QUEUE_MAX_LEN = int(os.getenv("QUEUE_MAX_LEN", "500"))          # membri massimi per coda (si tengono i prioritari)
+QUEUE_TTL_HOURS = int(os.getenv("QUEUE_TTL_HOURS", "48"))       # una coda non alimentata scade
+DEDUP_FILE = os.getenv("DEDUP_FILE")  # file locale per il dedup senza Upstash (opzionale)
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "keys").lower()  # "keys" (dedup:{asin}) o "bloom"
+DEDUP_BLOOM_CAPACITY = int(os.getenv("DEDUP_BLOOM_CAPACITY", "10000"))  # ASIN/giorno attesi
+DEDUP_BLOOM_FPR = float(os.getenv("DEDUP_BLOOM_FPR", "0.001"))          # falsi positivi sulla finestra
 POSTS_PER_SLOT = int(os.getenv("POSTS_PER_SLOT", "1"))
 
 # Ricerca
 KEYWORDS = [k.strip() for k in os.getenv("KEYWORDS","").split(";") if k.strip()]
-MAX_ITEMS_PER_KEYWORD = int(os.getenv("MAX_ITEMS_PER_KEYWORD", "5"))
+MAX_ITEMS_PER_KEYWORD = int(os.getenv("MAX_ITEMS_PER_KEYWORD", "5"))  # item per pagina (max 10)
+AMZ_KEYWORD_QUOTA = int(os.getenv("AMZ_KEYWORD_QUOTA", str(MAX_ITEMS_PER_KEYWORD)))  # offerte valide cercate per keyword (default: una pagina piena)
+AMZ_MAX_PAGES = int(os.getenv("AMZ_MAX_PAGES", "3"))          # pagine massime per keyword
+AMZ_CONCURRENCY = int(os.getenv("AMZ_CONCURRENCY", "4"))  # ricerche keyword in parallelo
+AMZ_SEARCH_TTL_MIN = int(os.getenv("AMZ_SEARCH_TTL_MIN", "120"))        # cache ricerca fresca (0 = off)
+AMZ_SEARCH_STALE_HOURS = int(os.getenv("AMZ_SEARCH_STALE_HOURS", "24"))  # oltre: ricerca sincrona
 
 # Slot pubblicazione (lun-ven)
 PUBLISH_HOURS = {9,11,13,15,17,19,21}
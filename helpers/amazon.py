@@ -1,115 +1,362 @@
 # helpers/amazon.py
-from typing import List, Dict
+import threading
+import time
+from typing import List, Dict, Iterator, Optional
+import config
 from config import (
-    AMAZON_ACCESS_KEY, AMAZON_SECRET_KEY, AMAZON_PARTNER_TAG,
-    MIN_STARS, MIN_DISCOUNT, MAX_ITEMS_PER_KEYWORD
+    MIN_STARS, MIN_DISCOUNT, MAX_ITEMS_PER_KEYWORD,
+    AMZ_TPS, AMZ_TPS_MIN, AMZ_MAX_RETRIES,
+    AMZ_SEARCH_TTL_MIN, AMZ_SEARCH_STALE_HOURS,
+    AMZ_KEYWORD_QUOTA, AMZ_MAX_PAGES
 )
+from .redis_store import cache_get, cache_set
 
 COUNTRY_CODE = "IT"  # marketplace Italia
 
+class RateLimiter:
+    """
+    Token bucket condiviso tra i thread: una chiamata aspetta solo se non ci
+    sono token disponibili. Il rate segue un AIMD: dimezza su TooManyRequests
+    e risale di un decimo del massimo per ogni chiamata riuscita.
+    """
+
+    def __init__(self, max_rate: float, min_rate: float, burst: float = 1.0):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # Prenota il token subito (anche in negativo) e dorme fuori dal lock
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10.0)
+
+    def on_throttle(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self.tokens = min(self.tokens, 0.0)
+            print(f"[amazon] TooManyRequests: rate ridotto a {self.rate:.2f} req/s")
+
+_limiter = RateLimiter(AMZ_TPS, AMZ_TPS_MIN)
+
+def _is_throttled(e: Exception) -> bool:
+    return type(e).__name__ in ("TooManyRequests", "TooManyRequestsException") or "TooManyRequests" in str(e)
+
+def _call(fn, *args, **kwargs):
+    """Esegue una chiamata PA-API passando dal rate limiter, con retry su throttling."""
+    for attempt in range(AMZ_MAX_RETRIES + 1):
+        _limiter.acquire()
+        try:
+            res = fn(*args, **kwargs)
+        except Exception as e:
+            if not _is_throttled(e):
+                raise
+            _limiter.on_throttle()
+            if attempt >= AMZ_MAX_RETRIES:
+                raise
+            continue
+        _limiter.on_success()
+        return res
+
+# Client condiviso: AmazonApi crea firma, pool HTTP (urllib3, keep-alive) e
+# thread pool interno a ogni istanza, quindi lo costruiamo una volta sola e
+# lo ricostruiamo solo se cambiano le credenziali.
+_api = None
+_api_creds = None
+_api_lock = threading.Lock()
+
 def _client():
+    global _api, _api_creds
     # import lazy per avere errori chiari se il pacchetto manca
     try:
         from amazon_paapi import AmazonApi
     except Exception as e:
         raise RuntimeError(f"amazon_paapi import failed: {e}")
-    
-    if not AMAZON_ACCESS_KEY or not AMAZON_SECRET_KEY:
+
+    creds = (config.AMAZON_ACCESS_KEY, config.AMAZON_SECRET_KEY, config.AMAZON_PARTNER_TAG, COUNTRY_CODE)
+    if not creds[0] or not creds[1]:
         raise RuntimeError("Amazon API credentials not configured")
-        
-    return AmazonApi(
-        AMAZON_ACCESS_KEY,
-        AMAZON_SECRET_KEY,
-        AMAZON_PARTNER_TAG,
-        COUNTRY_CODE,
+
+    with _api_lock:
+        if _api is None or _api_creds != creds:
+            print("[amazon] Creating AmazonApi client")
+            _api = AmazonApi(
+                *creds,
+                throttling=0,  # il ritmo delle chiamate lo gestisce _limiter
+            )
+            _api_creds = creds
+        return _api
+
+# Solo le risorse PA-API che finiscono nel dict prodotto (ASIN e
+# DetailPageURL sono sempre inclusi nella risposta)
+ITEM_RESOURCES = [
+    "ItemInfo.Title",
+    "ItemInfo.Features",
+    "ItemInfo.ByLineInfo",
+    "Offers.Listings.Price",
+    "Offers.Listings.SavingBasis",
+    "CustomerReviews.Count",
+    "CustomerReviews.StarRating",
+    "BrowseNodeInfo.WebsiteSalesRank",
+    "Images.Primary.Large",
+    "ParentASIN",
+]
+
+def _search_items(api, **kwargs):
+    """SearchItems con le sole ITEM_RESOURCES (AmazonApi.search_items le chiede tutte)."""
+    from amazon_paapi.helpers.requests import get_search_items_response
+    from amazon_paapi.sdk.models.partner_type import PartnerType
+    from amazon_paapi.sdk.models.search_items_request import SearchItemsRequest
+
+    request = SearchItemsRequest(
+        resources=ITEM_RESOURCES,
+        partner_type=PartnerType.ASSOCIATES,
+        marketplace=api.marketplace,
+        partner_tag=api.tag,
+        **kwargs,
     )
+    return get_search_items_response(api, request)
 
-def _safe(getter, default=None):
-    try:
-        v = getter()
-        return v if v is not None else default
-    except Exception:
-        return default
+def _get_items(api, asins: List[str]):
+    """GetItems con le sole ITEM_RESOURCES."""
+    from amazon_paapi.helpers.requests import get_items_response
+    from amazon_paapi.sdk.models.get_items_request import GetItemsRequest
+    from amazon_paapi.sdk.models.partner_type import PartnerType
 
-def search_candidates_for_keyword(keyword: str) -> List[Dict]:
-    try:
-        api = _client()
-        print(f"[amazon] Searching for keyword: {keyword}")
-        
-        # Search items
-        res = api.search_items(
-            keywords=keyword,
-            item_count=MAX_ITEMS_PER_KEYWORD,
-        )
+    request = GetItemsRequest(
+        resources=ITEM_RESOURCES,
+        partner_type=PartnerType.ASSOCIATES,
+        marketplace=api.marketplace,
+        partner_tag=api.tag,
+        item_ids=asins,
+    )
+    return get_items_response(api, request)
+
+def _get(obj, *path, default=None):
+    """Segue una catena di attributi fermandosi al primo None."""
+    for name in path:
+        if obj is None:
+            return default
+        obj = getattr(obj, name, None)
+    return default if obj is None else obj
+
+def _item_to_product(it, apply_filters: bool = True) -> Optional[Dict]:
+    """
+    Converte un Item PA-API (SearchItems o GetItems) nel dict prodotto usato
+    da selector e formatter. Con apply_filters scarta gli item sotto
+    MIN_STARS / MIN_DISCOUNT e restituisce None. I filtri economici
+    (prezzo, stelle, sconto) vengono applicati prima di leggere gli altri campi.
+    """
+    asin = getattr(it, "asin", None)
+    url = getattr(it, "detail_page_url", None)
+
+    # Prezzi
+    listings = _get(it, "offers", "listings")
+    listing = listings[0] if listings else None
+    price_now = _get(listing, "price", "amount")
+    price_old = _get(listing, "saving_basis", "amount")
+
+    # Validazione base
+    if not asin or not url or not price_now:
+        print(f"[amazon] Skipping item - missing basic data: asin={bool(asin)}, url={bool(url)}, price={bool(price_now)}")
+        return None
+
+    # Filtro stelle
+    reviews_info = getattr(it, "customer_reviews", None)
+    stars = _get(reviews_info, "star_rating", "value")
+    if apply_filters and stars is not None and float(stars) < MIN_STARS:
+        print(f"[amazon] Skipping {asin} - stars {stars} < {MIN_STARS}")
+        return None
+
+    # Calcola sconto
+    discount_pct = 0
+    if price_old and price_old > 0:
+        discount_pct = int(round((price_old - price_now) / price_old * 100))
+        if apply_filters and discount_pct < MIN_DISCOUNT:
+            print(f"[amazon] Skipping {asin} - discount {discount_pct}% < {MIN_DISCOUNT}%")
+            return None
+
+    # Campi "costosi" solo per gli item che passano i filtri
+    info = getattr(it, "item_info", None)
+    website_rank = _get(it, "browse_node_info", "website_sales_rank")
+    rank = _get(website_rank, "sales_rank")
+
+    return {
+        "source": "amazon",
+        "asin": asin,
+        "parent_asin": getattr(it, "parent_asin", None),
+        "title": (_get(info, "title", "display_value", default="")).strip(),
+        "url": url,
+        "image": _get(it, "images", "primary", "large", "url"),
+        "price_now": float(price_now),
+        "price_old": float(price_old) if price_old else None,
+        "discount_pct": int(discount_pct),
+        "stars": float(stars) if stars is not None else None,
+        "reviews": int(_get(reviews_info, "count", default=0)),
+        "category": _get(website_rank, "id"),
+        "category_name": _get(website_rank, "display_name", default=""),
+        "rank": int(rank) if rank else None,
+        "brand": _get(info, "by_line_info", "brand", "display_value"),
+        "features": list(_get(info, "features", "display_values", default=[])),
+    }
+
+def iter_keyword_products(keyword: str, quota: int = AMZ_KEYWORD_QUOTA,
+                          max_pages: int = AMZ_MAX_PAGES) -> Iterator[Dict]:
+    """
+    Ricerca PA-API paginata e lazy: scarica una pagina alla volta (item_page)
+    e restituisce i prodotti che passano i filtri man mano. Si ferma appena
+    ha trovato `quota` offerte valide, dopo `max_pages` pagine o quando
+    Amazon non ha altri risultati. Solleva eccezione in caso di errore.
+    """
+    api = _client()
+    found = 0
+    for page in range(1, min(max_pages, 10) + 1):  # PA-API: item_page 1..10
+        print(f"[amazon] Searching for keyword: {keyword} (page {page})")
+        try:
+            res = _call(
+                _search_items, api,
+                keywords=keyword,
+                item_count=MAX_ITEMS_PER_KEYWORD,
+                item_page=page,
+            )
+        except Exception as e:
+            # Oltre l'ultima pagina PA-API risponde "No items have been found"
+            if page > 1 and type(e).__name__ == "ItemsNotFound":
+                return
+            raise
 
         items = getattr(res, "items", []) or []
-        print(f"[amazon] Found {len(items)} items for '{keyword}'")
-        
-        out: List[Dict] = []
+        print(f"[amazon] Found {len(items)} items for '{keyword}' (page {page})")
 
         for it in items:
-            asin = _safe(lambda: it.asin)
-            title = _safe(lambda: it.item_info.title.display_value, "").strip()
-            url = _safe(lambda: it.detail_page_url)
-            img = _safe(lambda: it.images.primary.large.url)
-
-            # Prezzi
-            price_now = _safe(lambda: it.offers.listings[0].price.amount)
-            price_old = _safe(lambda: it.offers.listings[0].saving_basis.amount)
-
-            # Recensioni
-            stars = _safe(lambda: it.customer_reviews.star_rating)
-            reviews = _safe(lambda: it.customer_reviews.count, 0)
-
-            # Ranking
-            rank = _safe(lambda: it.browse_node_info.website_sales_rank.sales_rank.rank)
-            category = _safe(lambda: it.browse_node_info.website_sales_rank.sales_rank.product_category_id)
-
-            # Brand & features
-            features = _safe(lambda: it.item_info.features.display_values, [])
-            brand = _safe(lambda: it.item_info.by_line_info.brand.display_value)
-
-            # Validazione base
-            if not asin or not url or not price_now:
-                print(f"[amazon] Skipping item - missing basic data: asin={bool(asin)}, url={bool(url)}, price={bool(price_now)}")
-                continue
-                
-            # Filtro stelle
-            if stars is not None and float(stars) < MIN_STARS:
-                print(f"[amazon] Skipping {asin} - stars {stars} < {MIN_STARS}")
+            product = _item_to_product(it)
+            if product is None:
                 continue
+            print(f"[amazon] Added product {product['asin']}: {product['title'][:50]}... - {product['discount_pct']}% off")
+            yield product
+            found += 1
+            if found >= quota:
+                return
+
+        if len(items) < MAX_ITEMS_PER_KEYWORD:
+            return  # ultima pagina disponibile
+
+def _search_keyword(keyword: str) -> List[Dict]:
+    """Ricerca PA-API senza cache; solleva eccezione in caso di errore."""
+    out = list(iter_keyword_products(keyword))
+    print(f"[amazon] Returning {len(out)} valid products for '{keyword}'")
+    return out
+
+GET_ITEMS_BATCH = 10  # massimo ASIN per richiesta GetItems
+
+def refresh_items(asins: List[str], apply_filters: bool = False) -> List[Dict]:
+    """
+    Aggiorna prezzi e dati di ASIN già noti con GetItems (10 ASIN per
+    chiamata, ognuna passa dal rate limiter). Restituisce gli stessi dict
+    prodotto della ricerca per keyword, nell'ordine degli ASIN richiesti.
+    """
+    asins = list(dict.fromkeys(a for a in asins if a))
+    if not asins:
+        return []
+
+    try:
+        api = _client()
+    except Exception as e:
+        print(f"[amazon] Error refreshing items: {type(e).__name__}: {e}")
+        return []
+
+    by_asin: Dict[str, Dict] = {}
+    for i in range(0, len(asins), GET_ITEMS_BATCH):
+        batch = asins[i:i + GET_ITEMS_BATCH]
+        try:
+            items = _call(_get_items, api, batch) or []
+        except Exception as e:
+            print(f"[amazon] Error refreshing {len(batch)} items: {type(e).__name__}: {e}")
+            continue
+        for it in items:
+            product = _item_to_product(it, apply_filters=apply_filters)
+            if product:
+                by_asin[product["asin"]] = product
+
+    print(f"[amazon] Refreshed {len(by_asin)}/{len(asins)} items")
+    return [by_asin[a] for a in asins if a in by_asin]
+
+def _search_cache_key(keyword: str) -> str:
+    return f"search:{COUNTRY_CODE}:{keyword.strip().lower()}"
+
+def _fetch_and_cache(keyword: str) -> List[Dict]:
+    items = _search_keyword(keyword)
+    try:
+        cache_set(_search_cache_key(keyword), {"ts": int(time.time()), "items": items},
+                  ttl_seconds=AMZ_SEARCH_STALE_HOURS * 3600)
+    except Exception as e:
+        print(f"[amazon] Search cache error for '{keyword}': {e}")
+    return items
+
+# Keyword con un refresh in background già in corso
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+def _refresh_in_background(keyword: str):
+    with _refreshing_lock:
+        if keyword in _refreshing:
+            return
+        _refreshing.add(keyword)
+
+    def _run():
+        try:
+            _fetch_and_cache(keyword)
+            print(f"[amazon] Background refresh done for '{keyword}'")
+        except Exception as e:
+            print(f"[amazon] Background refresh failed for '{keyword}': {type(e).__name__}: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(keyword)
+
+    # Thread non-daemon: il processo cron attende la fine del refresh prima di uscire
+    threading.Thread(target=_run, name=f"search-refresh:{keyword}").start()
+
+def search_candidates_for_keyword(keyword: str) -> List[Dict]:
+    """
+    Prodotti validi per una keyword, con cache Redis della ricerca.
+    Entro AMZ_SEARCH_TTL_MIN la cache è fresca; oltre, e fino a
+    AMZ_SEARCH_STALE_HOURS, viene servita subito e aggiornata in background.
+    """
+    try:
+        if AMZ_SEARCH_TTL_MIN <= 0:
+            return _search_keyword(keyword)
+
+        entry = cache_get(_search_cache_key(keyword))
+        if entry and "items" in entry:
+            # copie: il selector modifica i dict (tag, dati Keepa)
+            items = [dict(p) for p in entry["items"]]
+            age = time.time() - entry.get("ts", 0)
+            if age < AMZ_SEARCH_TTL_MIN * 60:
+                print(f"[amazon] Search cache hit for '{keyword}' ({len(items)} items)")
+            else:
+                print(f"[amazon] Serving stale search for '{keyword}' ({int(age // 60)} min), refreshing")
+                _refresh_in_background(keyword)
+            return items
+
+        return [dict(p) for p in _fetch_and_cache(keyword)]
 
-            # Calcola sconto
-            discount_pct = 0
-            if price_old and price_old > 0:
-                discount_pct = int(round((price_old - price_now) / price_old * 100))
-                if discount_pct < MIN_DISCOUNT:
-                    print(f"[amazon] Skipping {asin} - discount {discount_pct}% < {MIN_DISCOUNT}%")
-                    continue
-
-            product = {
-                "source": "amazon",
-                "asin": asin,
-                "title": title,
-                "url": url,
-                "image": img,
-                "price_now": float(price_now),
-                "price_old": float(price_old) if price_old else None,
-                "discount_pct": int(discount_pct),
-                "stars": float(stars) if stars is not None else None,
-                "reviews": int(reviews or 0),
-                "category": category,
-                "rank": int(rank) if rank else None,
-                "brand": brand,
-                "features": features if features else [],
-            }
-            
-            print(f"[amazon] Added product {asin}: {title[:50]}... - {discount_pct}% off")
-            out.append(product)
-
-        print(f"[amazon] Returning {len(out)} valid products for '{keyword}'")
-        return out
-        
     except Exception as e:
         print(f"[amazon] Error searching for '{keyword}': {type(e).__name__}: {e}")
         return []
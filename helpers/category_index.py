@@ -0,0 +1,78 @@
+import time
+from typing import Dict, Optional
+from config import USE_KEEPA, KEEPA_API_KEY, KEEPA_DOMAIN, KEEPA_NONBLOCKING, CATEGORY_INDEX_DAYS
+from .keepa_new import get_client
+from .redis_store import cache_get, cache_set
+
+# Indice delle categorie radice: id Keepa -> [prodotti, rank più basso,
+# rank più alto osservato]. I sales rank di PA-API (WebsiteSalesRank) e di
+# Keepa (SALES) sono relativi alla categoria radice, quindi basta una
+# category_lookup(0) (1 token) ogni CATEGORY_INDEX_DAYS giorni, fatta dal
+# prefetch: lo slot legge solo la cache. Si carica una volta per processo;
+# le ricerche sono lookup su dict.
+
+INDEX_KEY = "catindex:v1"
+RETRY_KEY = "catindex:retry"
+RETRY_HOURS = 6  # dopo un refresh fallito
+
+_index: Optional[Dict] = None
+
+def refresh_index() -> Optional[Dict]:
+    """Scarica da Keepa le categorie radice e salva l'indice in redis_store."""
+    if not USE_KEEPA or not KEEPA_API_KEY:
+        return None
+    try:
+        roots = get_client().category_lookup(0, domain=KEEPA_DOMAIN, wait=not KEEPA_NONBLOCKING)
+    except Exception as e:
+        print(f"[category_index] Refresh error: {type(e).__name__}: {e} (retry in {RETRY_HOURS}h)")
+        cache_set(RETRY_KEY, {"ts": int(time.time())}, ttl_seconds=RETRY_HOURS * 3600)
+        return None
+    ids: Dict[str, list] = {}
+    names: Dict[str, str] = {}
+    for cat_id, cat in (roots or {}).items():
+        if not isinstance(cat, dict) or not (cat.get("productCount") or cat.get("highestRank")):
+            continue
+        ids[str(cat_id)] = [cat.get("productCount"), cat.get("lowestRank"), cat.get("highestRank")]
+        for name in (cat.get("name"), cat.get("contextFreeName")):
+            if name:
+                names[name.strip().lower()] = str(cat_id)
+    index = {"ids": ids, "names": names, "ts": int(time.time())}
+    cache_set(INDEX_KEY, index, ttl_seconds=CATEGORY_INDEX_DAYS * 24 * 3600)
+    print(f"[category_index] Refreshed: {len(ids)} root categories")
+    return index
+
+def ensure_index() -> Optional[Dict]:
+    """Per il prefetch: rifà l'indice se è scaduto e l'ultimo tentativo non è fallito da poco."""
+    global _index
+    index = cache_get(INDEX_KEY)
+    if index is None and cache_get(RETRY_KEY) is None:
+        index = refresh_index()
+    if index is not None:
+        _index = index
+    return index
+
+def load_index() -> Dict:
+    """Indice dalla cache (vuoto se manca); una sola volta per processo, nessuna chiamata Keepa."""
+    global _index
+    if _index is None:
+        _index = cache_get(INDEX_KEY) or {"ids": {}, "names": {}}
+    return _index
+
+def total_in_cat(c: Dict) -> Optional[int]:
+    """
+    Prodotti con sales rank nella categoria radice del candidato: per id
+    Keepa (root_category) o per nome (category_name di PA-API). Usa il rank
+    più alto osservato, che conta i soli prodotti classificati, e il numero
+    di prodotti se manca. None se la categoria non è nell'indice.
+    """
+    index = load_index()
+    entry = None
+    if c.get("root_category"):
+        entry = index["ids"].get(str(c["root_category"]))
+    if entry is None and c.get("category_name"):
+        cat_id = index["names"].get(str(c["category_name"]).strip().lower())
+        entry = index["ids"].get(cat_id) if cat_id else None
+    if entry is None:
+        return None
+    count, _, highest = entry
+    return highest or count
@@ -0,0 +1,50 @@
+import time
+from typing import Dict, Optional
+from config import KEEPA_TTL_HOURS, KEEPA_TTL_MIN_HOURS, KEEPA_TTL_MAX_HOURS
+
+# Politica di freschezza Keepa basata sulla volatilità osservata del prezzo:
+# a ogni fetch confrontiamo current_price_keepa con quello precedente e
+# aggiorniamo una media mobile esponenziale dei cambi (0 = stabile, 1 = cambia sempre).
+
+VOL_ALPHA = 0.3          # peso dell'ultima osservazione
+STABLE_BELOW = 0.2
+VOLATILE_ABOVE = 0.5
+DEAL_RATIO = 0.8         # prezzo sotto l'80% della media 90g = offerta lampo/deal
+PRICE_EPSILON = 0.01     # variazioni sotto 1 cent non contano
+VOL_TTL_SECONDS = 30 * 24 * 3600
+
+def observe(prev: Optional[Dict], data: Dict) -> Dict:
+    """Nuovo stato di volatilità dopo un fetch Keepa."""
+    price = data.get("current_price_keepa")
+    avg_90 = data.get("avg_90")
+    deal = bool(price and avg_90 and price < avg_90 * DEAL_RATIO)
+    if not prev or prev.get("last") is None or price is None:
+        return {"last": price, "vol": (prev or {}).get("vol", 0.5), "obs": 1, "deal": deal, "ts": int(time.time())}
+    changed = abs(price - prev["last"]) > PRICE_EPSILON
+    vol = (1 - VOL_ALPHA) * prev.get("vol", 0.5) + VOL_ALPHA * (1.0 if changed else 0.0)
+    return {"last": price, "vol": round(vol, 4), "obs": prev.get("obs", 0) + 1, "deal": deal, "ts": int(time.time())}
+
+def ttl_seconds(state: Optional[Dict]) -> int:
+    """TTL della cache Keepa: lunga per prezzi stabili, corta per volatili e deal."""
+    if not state or state.get("obs", 0) < 2:
+        hours = KEEPA_TTL_HOURS  # storia insufficiente
+    elif state.get("deal") or state["vol"] >= VOLATILE_ABOVE:
+        hours = KEEPA_TTL_MIN_HOURS
+    elif state["vol"] <= STABLE_BELOW:
+        hours = KEEPA_TTL_MAX_HOURS
+    else:
+        hours = KEEPA_TTL_HOURS
+    return int(hours * 3600)
+
+def update_hours(state: Optional[Dict]) -> Optional[int]:
+    """
+    Parametro `update` di Keepa: None = nessun refresh forzato (nessun token
+    extra) per i prodotti stabili, 1 per volatili e deal, 2 altrimenti.
+    """
+    if not state or state.get("obs", 0) < 2:
+        return 2
+    if state.get("deal") or state["vol"] >= VOLATILE_ABOVE:
+        return 1
+    if state["vol"] <= STABLE_BELOW:
+        return None
+    return 2
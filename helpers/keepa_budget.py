@@ -0,0 +1,94 @@
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from zoneinfo import ZoneInfo
+from config import (
+    USE_KEEPA, KEEPA_API_KEY, KEEPA_MAX_ENRICH, KEEPA_TOKENS_PER_ASIN,
+    KEEPA_TOKEN_RESERVE, PUBLISH_HOURS, TIMEZONE
+)
+from .keepa_new import get_client, _status_field
+from .redis_store import cache_get, cache_set, queue_add
+
+BUDGET_KEY = "keepa:budget"
+PREFETCH_QUEUE = "keepa_prefetch"
+TOKEN_LIFETIME_MIN = 60  # Keepa fa scadere i token non usati dopo un'ora
+
+TZ = ZoneInfo(TIMEZONE)
+
+def is_publish_slot(now: Optional[datetime] = None) -> bool:
+    now = now or datetime.now(TZ)
+    return now.weekday() < 5 and now.hour in PUBLISH_HOURS
+
+def next_slot(now: Optional[datetime] = None) -> datetime:
+    """Prossimo slot di pubblicazione (lun-ven, PUBLISH_HOURS) dopo `now`."""
+    now = now or datetime.now(TZ)
+    t = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    for _ in range(24 * 7):
+        if is_publish_slot(t):
+            return t
+        t += timedelta(hours=1)
+    return t
+
+def record_budget() -> Optional[Dict]:
+    """Salva in redis_store il saldo token che il client Keepa ha visto per ultimo (nessuna chiamata)."""
+    if not USE_KEEPA or not KEEPA_API_KEY:
+        return None
+    k = get_client()
+    rate = _status_field(k, "refillRate")
+    if rate is None:
+        return None
+    budget = {
+        "tokens_left": int(k.tokens_left),
+        "refill_rate": float(rate),  # token/minuto
+        "ts": int(time.time()),
+    }
+    cache_set(BUDGET_KEY, budget, ttl_seconds=TOKEN_LIFETIME_MIN * 60)
+    return budget
+
+def refresh_budget() -> Optional[Dict]:
+    """Legge saldo e refill da Keepa (la richiesta di stato non consuma token)."""
+    if not USE_KEEPA or not KEEPA_API_KEY:
+        return None
+    try:
+        get_client().update_status()
+        budget = record_budget()
+    except Exception as e:
+        print(f"[keepa_budget] Status error: {type(e).__name__}: {e}")
+        budget = None
+    if budget is None:
+        budget = cache_get(BUDGET_KEY)
+    if budget:
+        print(f"[keepa_budget] tokens_left={budget['tokens_left']}, refill={budget['refill_rate']}/min")
+    return budget
+
+def slot_allowance(budget: Optional[Dict]) -> int:
+    """
+    Quanti ASIN arricchire in questo slot. I token non spesi scadono
+    prima del prossimo slot, quindi si usa tutto il saldo tranne la
+    riserva; senza informazioni sul saldo vale KEEPA_MAX_ENRICH.
+    """
+    if not budget:
+        return KEEPA_MAX_ENRICH
+    spendable = budget["tokens_left"] - KEEPA_TOKEN_RESERVE
+    return max(0, int(spendable // KEEPA_TOKENS_PER_ASIN))
+
+def prefetch_allowance(budget: Optional[Dict], now: Optional[datetime] = None) -> int:
+    """
+    Quanti ASIN si possono arricchire fuori slot senza lasciare il prossimo
+    slot con meno di KEEPA_MAX_ENRICH ASIN di token (più la riserva).
+    """
+    if not budget:
+        return 0
+    now = now or datetime.now(TZ)
+    minutes = (next_slot(now) - now).total_seconds() / 60.0
+    refill = budget["refill_rate"] * min(minutes, TOKEN_LIFETIME_MIN)
+    needed_at_slot = KEEPA_MAX_ENRICH * KEEPA_TOKENS_PER_ASIN + KEEPA_TOKEN_RESERVE
+    spendable = min(budget["tokens_left"] - KEEPA_TOKEN_RESERVE,
+                    budget["tokens_left"] + refill - needed_at_slot)
+    return max(0, int(spendable // KEEPA_TOKENS_PER_ASIN))
+
+def queue_prefetch(priorities: Dict[str, float]):
+    """Mette in coda ASIN da arricchire nelle ore fuori slot (priorità = punteggio pre-Keepa)."""
+    if priorities and USE_KEEPA and KEEPA_API_KEY:
+        queue_add(PREFETCH_QUEUE, priorities)
+        print(f"[keepa_budget] Queued {len(priorities)} ASIN for prefetch")
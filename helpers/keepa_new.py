@@ -1,8 +1,16 @@
-from typing import Dict, Optional
-import keepa
+from typing import Dict, List, Optional, Set, Tuple
+import json
 import time
-from config import KEEPA_API_KEY, USE_KEEPA, KEEPA_TTL_HOURS, KEEPA_DOMAIN
-from .redis_store import cache_get, cache_set
+import keepa
+from . import freshness, price_history
+from config import (
+    KEEPA_API_KEY, USE_KEEPA, KEEPA_DOMAIN,
+    KEEPA_NEG_TTL_HOURS, KEEPA_NEG_ERROR_MIN, KEEPA_NEG_ERROR_MAX_MIN,
+    KEEPA_NONBLOCKING, KEEPA_TOKENS_PER_ASIN, KEEPA_TTL_MIN_HOURS, KEEPA_MIGRATE_LEGACY
+)
+from .redis_store import (
+    cache_get, cache_set, cache_get_many, cache_set_many, cache_ttl_many, cache_delete_many, queue_add
+)
 
 _client = None
 
@@ -12,153 +20,496 @@ def get_client():
         _client = keepa.Keepa(KEEPA_API_KEY)
     return _client
 
-def enrich_with_keepa(asin: str) -> Optional[Dict]:
+KEEPA_BATCH_SIZE = 100  # limite di ASIN per singola richiesta Keepa
+
+def _make_serializable(value):
+    """Converte valori non serializzabili in formati JSON-safe"""
+    if value is None:
+        return None
+    try:
+        # Testa se è serializzabile
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        # Se non serializzabile, converti in stringa o valore base
+        if hasattr(value, 'isoformat'):  # datetime objects
+            return value.isoformat()
+        elif isinstance(value, (int, float, str, bool)):
+            return value
+        else:
+            return str(value)
+
+def _json_safe(value):
+    if isinstance(value, dict):
+        return {str(k): _json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(v) for v in value]
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        value = value.item()  # scalari numpy
+    return _make_serializable(value)
+
+# Campi del prodotto Keepa letti da _parse_product: sono il payload
+# compatto salvato in cache e riletto quando cambia il parser.
+STATS_FIELDS = ("current", "avg", "avg90", "min", "max")
+BUYBOX_FIELDS = ("buyBoxIsAmazon", "buyBoxIsPrimeEligible", "buyBoxIsPrimeExclusive")
+
+def _compact(item: Dict) -> Dict:
+    stats_parsed = item.get("stats_parsed") or {}
+    stats = item.get("stats") or {}
+    return _json_safe({
+        "stats_parsed": {k: stats_parsed[k] for k in STATS_FIELDS if k in stats_parsed},
+        "stats": {k: stats[k] for k in BUYBOX_FIELDS if k in stats},
+        "categoryTree": (item.get("categoryTree") or [])[-1:],
+        "rootCategory": item.get("rootCategory"),
+    })
+
+def _parse_product(asin: str, item) -> Optional[Dict]:
     """
-    Nuovo parser Keepa che usa stats_parsed.
-    Bypassa il problema di cache del vecchio file.
+    Estrae i campi che ci servono da un prodotto Keepa usando stats_parsed.
+    Restituisce None se non ci sono dati utili.
     """
-    if not USE_KEEPA or not KEEPA_API_KEY:
-        print(f"[keepa_new] Disabled: USE_KEEPA={USE_KEEPA}, has_key={bool(KEEPA_API_KEY)}")
+    if not isinstance(item, dict):
+        print(f"[keepa_new] Invalid item type: {type(item)}")
+        return None
+
+    # USA IL NUOVO PARSING CON stats_parsed
+    stats_parsed = item.get("stats_parsed", {})
+
+    if not stats_parsed:
+        print(f"[keepa_new] No stats_parsed field for {asin}")
         return None
-    
-    # Controlla cache
-    cache_key = f"keepa_fixed:{asin}"
-    cached = cache_get(cache_key)
-    if cached:
-        print(f"[keepa_new] Cache hit for {asin}")
-        return cached
 
+    print(f"[keepa_new] Found stats_parsed with keys: {list(stats_parsed.keys())}")
+
+    # Estrai dati dai campi parsed (già in euro)
+    current_data = stats_parsed.get("current", {})
+    avg_data = stats_parsed.get("avg", {})  # Media generale
+    avg90_data = stats_parsed.get("avg90", avg_data)  # Media 90 giorni se disponibile
+    min_data = stats_parsed.get("min", {})
+    max_data = stats_parsed.get("max", {})
+
+    # Prezzi correnti
+    current_price = current_data.get("NEW") or current_data.get("AMAZON")
+    list_price = current_data.get("LISTPRICE")
+
+    # Prezzi storici (media 90 giorni)
+    avg_90 = avg90_data.get("NEW") or avg90_data.get("AMAZON")
+
+    # Prezzi min/max - estrarre solo il valore numerico se sono tuple
+    min_price = min_data.get("NEW") or min_data.get("AMAZON")
+    max_price = max_data.get("NEW") or max_data.get("AMAZON")
+
+    # Se min/max sono tuple (timestamp, prezzo), estrai solo il prezzo
+    if isinstance(min_price, (list, tuple)) and len(min_price) > 1:
+        min_price = min_price[1]
+    if isinstance(max_price, (list, tuple)) and len(max_price) > 1:
+        max_price = max_price[1]
+
+    # Sales rank
+    sales_rank = current_data.get("SALES")
+
+    # Rating/Reviews - potrebbero essere in altri campi
+    rating = None
+    review_count = None
+
+    # Buy Box e Prime info dai dati raw
+    stats_raw = item.get("stats", {})
+    buybox_amazon = stats_raw.get("buyBoxIsAmazon")
+    prime = stats_raw.get("buyBoxIsPrimeEligible") or stats_raw.get("buyBoxIsPrimeExclusive")
+
+    # Categoria
+    category_name = None
+    category_tree = item.get("categoryTree", [])
+    if category_tree:
+        try:
+            category_name = category_tree[-1].get("name")
+        except (AttributeError, IndexError):
+            pass
+
+    # Costruisci risultato - assicurati che tutti i valori siano serializzabili
+    data = {
+        "avg_90": _make_serializable(avg_90),
+        "min_price": _make_serializable(min_price),
+        "max_price": _make_serializable(max_price),
+        "buybox_amazon": bool(buybox_amazon) if buybox_amazon is not None else None,
+        "prime": bool(prime) if prime else False,
+        "rating": _make_serializable(rating),
+        "review_count": _make_serializable(review_count),
+        "category_name": _make_serializable(category_name),
+        "root_category": _make_serializable(item.get("rootCategory")),
+        "sales_rank": int(sales_rank) if sales_rank else None,
+        "current_price_keepa": _make_serializable(current_price),
+        "list_price_keepa": _make_serializable(list_price)
+    }
+
+    # Solo se abbiamo dati utili
+    useful_data = [avg_90, min_price, max_price, current_price, sales_rank]
+    if not any(v is not None for v in useful_data):
+        print(f"[keepa_new] No useful data extracted for {asin}")
+        return None
+
+    print(f"[keepa_new] SUCCESS {asin}: current={current_price}€, avg90={avg_90}€, min={min_price}€, max={max_price}€, rank={sales_rank}")
+    return data
+
+def _query_batch(asins: List[str], update: Optional[int] = 2, wait: bool = True,
+                 days: int = 90) -> List[Dict]:
+    k = get_client()
+    print(f"[keepa_new] Querying {len(asins)} ASIN on domain IT (update={update}, days={days})...")
+    products = k.query(
+        asins,
+        domain="IT",
+        stats=90,
+        days=days,
+        history=True,
+        rating=True,
+        buybox=True,
+        update=update,
+        wait=wait
+    )
+    if not products or not isinstance(products, list):
+        return []
+    return products
+
+# Schema della cache Keepa: payload compatto + dati estratti, etichettati
+# con la versione del parser. Quando _parse_product cambia si aumenta
+# PARSER_VERSION e le voci in cache vengono rilette in locale alla prima
+# lettura, senza richieste Keepa. Con KEEPA_MIGRATE_LEGACY si migrano
+# allo stesso modo le chiavi di keepa_new fino a schema 1 (TTL massima 12h,
+# quindi basta tenerlo attivo il primo giorno dopo l'aggiornamento). Le voci
+# keepa:{asin} di keepa_client non si migrano: avg_90 era stimata come
+# (min+max)/2.
+CACHE_SCHEMA = 2
+PARSER_VERSION = 1
+LEGACY_PREFIXES = ("keepa_fixed:",) if KEEPA_MIGRATE_LEGACY else ()
+
+def _cache_key(asin: str) -> str:
+    return f"keepa:v{CACHE_SCHEMA}:{asin}"
+
+def _neg_key(asin: str) -> str:
+    return f"keepa_neg:{asin}"
+
+def _vol_key(asin: str) -> str:
+    return f"keepa_vol:{asin}"
+
+# Coda degli ASIN rimandati per mancanza di token (modalità non bloccante)
+# o perché Keepa è in pausa dopo un errore: vengono ripresi al run
+# successivo (vedi selector).
+DEFER_QUEUE = "keepa_deferred"
+
+def _defer(asins: List[str], priorities: Dict[str, float]):
+    if asins:
+        queue_add(DEFER_QUEUE, {a: priorities.get(a, 0.0) for a in asins})
+        print(f"[keepa_new] Deferred {len(asins)} ASIN to next run")
+
+def _status_field(k, name):
+    # keepa >= 1.4 usa un oggetto Status, le versioni precedenti un dict
+    status = getattr(k, "status", None)
+    if isinstance(status, dict):
+        return status.get(name)
+    return getattr(status, name, None)
+
+def _affordable(n: int) -> int:
+    """Quanti ASIN su n si possono chiedere ora col saldo noto (n se il saldo non è noto)."""
+    k = get_client()
+    # keepa segna tokens_left=0 finché non ha visto una risposta: prima di
+    # fidarsi del saldo si chiede lo stato (gratuito)
+    if _status_field(k, "refillRate") is None:
+        try:
+            k.update_status()
+        except Exception as e:
+            print(f"[keepa_new] Status error: {type(e).__name__}: {e}")
+    tokens = getattr(k, "tokens_left", None)
+    if tokens is None or _status_field(k, "refillRate") is None:
+        return n
+    return max(0, min(n, int(tokens // KEEPA_TOKENS_PER_ASIN)))
+
+# Cache negativa: ASIN senza dati utili non vengono richiesti di nuovo
+# per un po'. "no_product"/"no_stats" hanno una TTL fissa, "error" un
+# backoff esponenziale per ASIN.
+NEG_NO_PRODUCT = "no_product"
+NEG_NO_STATS = "no_stats"
+NEG_ERROR = "error"
+
+def _err_key(asin: str) -> str:
+    # Contatore degli errori consecutivi: deve sopravvivere al blocco in
+    # keepa_neg:{asin}, altrimenti il backoff ripartirebbe sempre da 1
+    return f"keepa_err:{asin}"
+
+ERR_COUNTER_TTL = KEEPA_NEG_ERROR_MAX_MIN * 60 * 4
+
+# Errori dell'intera richiesta (timeout, chiave non valida, REQUEST_REJECTED)
+# non dicono nulla sui singoli ASIN: invece della cache negativa c'è un solo
+# backoff globale, che cresce come quello per ASIN e mette in pausa Keepa.
+OUTAGE_KEY = "keepa:outage"
+
+def _mark_outage(previous: Optional[Dict], error: Exception) -> Dict:
+    attempts = int((previous or {}).get("attempts", 0)) + 1
+    ttl = _neg_ttl(NEG_ERROR, attempts)
+    state = {"attempts": attempts, "until": int(time.time()) + ttl}
+    print(f"[keepa_new] Request failed ({type(error).__name__}: {error}): "
+          f"Keepa paused for {ttl // 60} min (attempt {attempts})")
     try:
-        k = get_client()
-        
-        print(f"[keepa_new] Querying {asin} on domain IT...")
-        
-        # Query Keepa
-        products = k.query(
-            asin, 
-            domain="IT",
-            stats=90,
-            days=90,
-            history=False,
-            rating=True,
-            buybox=True,
-            update=2,
-            wait=True
-        )
-        
-        if not products or not isinstance(products, list) or len(products) == 0:
-            print(f"[keepa_new] No data returned for {asin}")
-            return None
-            
-        item = products[0]
-        
-        if not isinstance(item, dict):
-            print(f"[keepa_new] Invalid item type: {type(item)}")
-            return None
-            
-        # USA IL NUOVO PARSING CON stats_parsed
-        stats_parsed = item.get("stats_parsed", {})
-        
-        if not stats_parsed:
-            print(f"[keepa_new] No stats_parsed field for {asin}")
-            return None
-        
-        print(f"[keepa_new] Found stats_parsed with keys: {list(stats_parsed.keys())}")
-        
-        # Estrai dati dai campi parsed (già in euro)
-        current_data = stats_parsed.get("current", {})
-        avg_data = stats_parsed.get("avg", {})  # Media generale
-        avg90_data = stats_parsed.get("avg90", avg_data)  # Media 90 giorni se disponibile
-        min_data = stats_parsed.get("min", {})
-        max_data = stats_parsed.get("max", {})
-        
-        # Prezzi correnti
-        current_price = current_data.get("NEW") or current_data.get("AMAZON")
-        list_price = current_data.get("LISTPRICE")
-        
-        # Prezzi storici (media 90 giorni)
-        avg_90 = avg90_data.get("NEW") or avg90_data.get("AMAZON")
-        
-        # Prezzi min/max - estrarre solo il valore numerico se sono tuple
-        min_price = min_data.get("NEW") or min_data.get("AMAZON")
-        max_price = max_data.get("NEW") or max_data.get("AMAZON")
-        
-        # Se min/max sono tuple (timestamp, prezzo), estrai solo il prezzo
-        if isinstance(min_price, (list, tuple)) and len(min_price) > 1:
-            min_price = min_price[1]
-        if isinstance(max_price, (list, tuple)) and len(max_price) > 1:
-            max_price = max_price[1]
-        
-        # Sales rank
-        sales_rank = current_data.get("SALES")
-        
-        # Rating/Reviews - potrebbero essere in altri campi
-        rating = None
-        review_count = None
-        
-        # Buy Box e Prime info dai dati raw
-        stats_raw = item.get("stats", {})
-        buybox_amazon = stats_raw.get("buyBoxIsAmazon")
-        prime = stats_raw.get("buyBoxIsPrimeEligible") or stats_raw.get("buyBoxIsPrimeExclusive")
-        
-        # Categoria
-        category_name = None
-        category_tree = item.get("categoryTree", [])
-        if category_tree:
-            try:
-                category_name = category_tree[-1].get("name")
-            except (AttributeError, IndexError):
-                pass
-
-        # Costruisci risultato - assicurati che tutti i valori siano serializzabili
-        def make_serializable(value):
-            """Converte valori non serializzabili in formati JSON-safe"""
-            if value is None:
-                return None
-            try:
-                # Testa se è serializzabile
-                import json
-                json.dumps(value)
-                return value
-            except (TypeError, ValueError):
-                # Se non serializzabile, converti in stringa o valore base
-                if hasattr(value, 'isoformat'):  # datetime objects
-                    return value.isoformat()
-                elif isinstance(value, (int, float, str, bool)):
-                    return value
-                else:
-                    return str(value)
-
-        data = {
-            "avg_90": make_serializable(avg_90),
-            "min_price": make_serializable(min_price),
-            "max_price": make_serializable(max_price),
-            "buybox_amazon": bool(buybox_amazon) if buybox_amazon is not None else None,
-            "prime": bool(prime) if prime else False,
-            "rating": make_serializable(rating),
-            "review_count": make_serializable(review_count),
-            "category_name": make_serializable(category_name),
-            "sales_rank": int(sales_rank) if sales_rank else None,
-            "current_price_keepa": make_serializable(current_price),
-            "list_price_keepa": make_serializable(list_price)
-        }
-        
-        # Cache solo se abbiamo dati utili
-        useful_data = [avg_90, min_price, max_price, current_price, sales_rank]
-        if any(v is not None for v in useful_data):
+        cache_set(OUTAGE_KEY, state, ttl_seconds=ERR_COUNTER_TTL)
+    except Exception as cache_error:
+        print(f"[keepa_new] Cache error saving Keepa pause: {cache_error}")
+    return state
+
+def _neg_ttl(reason: str, attempts: int) -> int:
+    if reason == NEG_ERROR:
+        minutes = KEEPA_NEG_ERROR_MIN * (2 ** max(0, attempts - 1))
+        return int(min(minutes, KEEPA_NEG_ERROR_MAX_MIN) * 60)
+    return KEEPA_NEG_TTL_HOURS * 3600
+
+def _mark_negative(reasons: Dict[str, str]):
+    if not reasons:
+        return
+    errors = [a for a, r in reasons.items() if r == NEG_ERROR]
+    previous = cache_get_many(_err_key(a) for a in errors) if errors else {}
+    by_ttl: Dict[int, Dict[str, Dict]] = {}
+    counters: Dict[str, Dict] = {}
+    now = int(time.time())
+    for asin, reason in reasons.items():
+        attempts = 1
+        if reason == NEG_ERROR:
+            attempts = int((previous.get(_err_key(asin)) or {}).get("attempts", 0)) + 1
+            counters[_err_key(asin)] = {"attempts": attempts, "ts": now}
+        ttl = _neg_ttl(reason, attempts)
+        by_ttl.setdefault(ttl, {})[_neg_key(asin)] = {"reason": reason, "attempts": attempts, "ts": now}
+        print(f"[keepa_new] Negative cache {asin}: {reason} (attempt {attempts}, {ttl // 60} min)")
+    try:
+        for ttl, items in by_ttl.items():
+            cache_set_many(items, ttl_seconds=ttl)
+        cache_set_many(counters, ttl_seconds=ERR_COUNTER_TTL)
+    except Exception as cache_error:
+        print(f"[keepa_new] Negative cache error: {cache_error}")
+
+def _write_entries(entries: Dict[str, Dict]):
+    """Salva voci di cache Keepa, ognuna con la TTL residua fino a entry["exp"]."""
+    by_ttl: Dict[int, Dict[str, Dict]] = {}
+    now = int(time.time())
+    for asin, entry in entries.items():
+        by_ttl.setdefault(max(60, entry["exp"] - now), {})[_cache_key(asin)] = entry
+    for ttl, items in by_ttl.items():
+        cache_set_many(items, ttl_seconds=ttl)
+
+def _upgrade(asin: str, entry: Dict) -> bool:
+    """Rilegge una voce scritta da un parser precedente; True se è cambiata."""
+    if entry.get("parser") == PARSER_VERSION or not entry.get("raw"):
+        return False
+    data = _parse_product(asin, entry["raw"])
+    if data is not None:
+        data.update(entry.get("extra") or {})
+    entry.update(parser=PARSER_VERSION, data=data)
+    return True
+
+def _legacy_keys(asin: str) -> List[str]:
+    return [p + asin for p in LEGACY_PREFIXES]
+
+def _migrate_legacy(asins: List[str], cached: Dict[str, Dict]) -> Dict[str, Dict]:
+    """
+    Converte le voci dei vecchi formati (solo dati estratti, senza payload)
+    nello schema attuale mantenendo la scadenza, e cancella le chiavi vecchie.
+    `cached` è la lettura bulk di lookup_cache, che include già le chiavi vecchie.
+    """
+    found = {k: cached[k] for a in asins for k in _legacy_keys(a) if cached.get(k)}
+    if not found:
+        return {}
+    ttls = cache_ttl_many(found)
+    now = int(time.time())
+    entries: Dict[str, Dict] = {}
+    for asin in asins:
+        key = next((k for k in _legacy_keys(asin) if k in found), None)
+        if key:
+            ttl = ttls.get(key) or KEEPA_TTL_MIN_HOURS * 3600
+            entries[asin] = {"parser": None, "raw": None, "extra": {}, "data": found[key], "exp": now + ttl}
+    try:
+        _write_entries(entries)
+        cache_delete_many(found)
+        print(f"[keepa_new] Migrated {len(entries)} legacy cache entries")
+    except Exception as cache_error:
+        print(f"[keepa_new] Legacy migration error: {cache_error}")
+    return entries
+
+def lookup_cache(asins: List[str]) -> Tuple[Dict[str, Dict], Set[str]]:
+    """
+    Una sola lettura bulk della cache: restituisce i dati Keepa in cache e
+    gli ASIN in cache negativa (da non richiedere ora). Voci di un parser
+    precedente o di un vecchio formato vengono aggiornate qui (migrazione lazy).
+    """
+    if not USE_KEEPA or not KEEPA_API_KEY:
+        return {}, set()
+    asins = list(dict.fromkeys(a for a in asins if a))
+    keys = [_cache_key(a) for a in asins] + [_neg_key(a) for a in asins]
+    keys += [k for a in asins for k in _legacy_keys(a)]
+    cached = cache_get_many(keys)
+    entries = {a: cached[_cache_key(a)] for a in asins if cached.get(_cache_key(a))}
+    entries.update(_migrate_legacy([a for a in asins if a not in entries and not cached.get(_neg_key(a))], cached))
+
+    upgraded = {a: e for a, e in entries.items() if _upgrade(a, e)}
+    if upgraded:
+        print(f"[keepa_new] Re-parsed {len(upgraded)} cache entries (parser v{PARSER_VERSION})")
+        try:
+            _write_entries(upgraded)
+        except Exception as cache_error:
+            print(f"[keepa_new] Cache error while re-parsing: {cache_error}")
+
+    out: Dict[str, Dict] = {}
+    blocked: Set[str] = set()
+    for asin in asins:
+        hit = (entries.get(asin) or {}).get("data")
+        if hit:
+            print(f"[keepa_new] Cache hit for {asin}")
+            out[asin] = hit
+        elif cached.get(_neg_key(asin)):
+            blocked.add(asin)
+    if blocked:
+        print(f"[keepa_new] Skipping {len(blocked)} ASIN in negative cache")
+    return out, blocked
+
+def fetch_many(asins: List[str], priorities: Optional[Dict[str, float]] = None,
+               wait: bool = not KEEPA_NONBLOCKING) -> Dict[str, Dict]:
+    """
+    Interroga Keepa (senza guardare la cache) a blocchi di max 100 ASIN,
+    salva in cache i risultati (anche negativi) e restituisce {asin: dati}.
+    Refresh forzato (`update`) e TTL dipendono dalla volatilità del prezzo
+    osservata nei fetch precedenti (vedi helpers/freshness.py); lo storico
+    prezzi locale fa chiedere solo i giorni mancanti (helpers/price_history.py).
+    Con wait=False non aspetta mai la ricarica dei token: gli ASIN che non
+    si possono pagare finiscono in DEFER_QUEUE (priorità da `priorities`),
+    come quelli chiesti mentre Keepa è in pausa dopo un errore di richiesta.
+    """
+    if not USE_KEEPA or not KEEPA_API_KEY:
+        return {}
+    missing = list(dict.fromkeys(a for a in asins if a))
+    if not missing:
+        return {}
+    priorities = priorities or {}
+    vols = cache_get_many(_vol_key(a) for a in missing)
+    hists = price_history.load_many(missing)
+
+    # Keepa accetta un solo `update` e un solo `days` per richiesta: raggruppa
+    groups: Dict[Tuple[Optional[int], int], List[str]] = {}
+    for asin in missing:
+        key = (freshness.update_hours(vols.get(_vol_key(asin))), price_history.days_needed(hists.get(asin)))
+        groups.setdefault(key, []).append(asin)
+
+    out: Dict[str, Dict] = {}
+    deferred: List[str] = []
+    outage = cache_get(OUTAGE_KEY)
+    for (update, days), group in groups.items():
+        for i in range(0, len(group), KEEPA_BATCH_SIZE):
+            chunk = group[i:i + KEEPA_BATCH_SIZE]
+            if outage and outage["until"] > time.time():
+                deferred.extend(chunk)
+                continue
+            if not wait:
+                n = _affordable(len(chunk))
+                deferred.extend(chunk[n:])
+                chunk = chunk[:n]
+                if not chunk:
+                    continue
             try:
-                cache_set(cache_key, data, ttl_seconds=KEEPA_TTL_HOURS * 3600)
-                print(f"[keepa_new] SUCCESS {asin}: current={current_price}€, avg90={avg_90}€, min={min_price}€, max={max_price}€, rank={sales_rank}")
-                return data
-            except Exception as cache_error:
-                print(f"[keepa_new] Cache error for {asin}: {cache_error}")
-                # Restituisci i dati anche se la cache fallisce
-                print(f"[keepa_new] SUCCESS (no cache) {asin}: current={current_price}€, avg90={avg_90}€, min={min_price}€, max={max_price}€, rank={sales_rank}")
-                return data
-        else:
-            print(f"[keepa_new] No useful data extracted for {asin}")
-            return None
-        
+                fetched, rejected = _fetch_chunk(chunk, update, days, vols, hists, wait)
+            except Exception as e:
+                outage = _mark_outage(outage, e)
+                deferred.extend(chunk)
+                continue
+            if outage:
+                # Keepa ha risposto: fine della pausa
+                cache_delete_many([OUTAGE_KEY])
+                outage = None
+            out.update(fetched)
+            deferred.extend(rejected)
+    _defer(deferred, priorities)
+    return out
+
+def _fetch_chunk(chunk: List[str], update: Optional[int], days: int, vols: Dict[str, Dict],
+                 hists: Dict[str, price_history.Hist], wait: bool) -> Tuple[Dict[str, Dict], List[str]]:
+    """
+    Una richiesta Keepa; restituisce (dati, ASIN rifiutati per mancanza di
+    token). Gli altri errori della richiesta vengono rilanciati.
+    """
+    try:
+        products = _query_batch(chunk, update=update, wait=wait, days=days)
     except Exception as e:
-        print(f"[keepa_new] Error for {asin}: {type(e).__name__}: {e}")
-        return None
+        if not wait and "NOT_ENOUGH_TOKEN" in str(e):
+            return {}, chunk
+        raise
+
+    by_asin = {p.get("asin"): p for p in products if isinstance(p, dict)}
+    fetched: Dict[str, Dict] = {}
+    negative: Dict[str, str] = {}
+    new_hists: Dict[str, price_history.Hist] = {}
+    raws: Dict[str, Tuple[Dict, Dict]] = {}
+    for asin in chunk:
+        item = by_asin.get(asin)
+        if item is None:
+            print(f"[keepa_new] No data returned for {asin}")
+            negative[asin] = NEG_NO_PRODUCT
+            continue
+        try:
+            raw = _compact(item)
+            data = _parse_product(asin, raw)
+        except Exception as e:
+            print(f"[keepa_new] Error for {asin}: {type(e).__name__}: {e}")
+            negative[asin] = NEG_ERROR
+            continue
+        if data is not None:
+            # Medie/minimi esatti dallo storico locale al posto di stats
+            extra: Dict = {}
+            hist = price_history.merge(hists.get(asin), price_history.from_keepa(item))
+            if hist is not None:
+                new_hists[asin] = hist
+                extra = price_history.summary(hist)
+                data.update(extra)
+            fetched[asin] = data
+            raws[asin] = (raw, extra)
+        else:
+            negative[asin] = NEG_NO_STATS
+
+    try:
+        entries: Dict[str, Dict] = {}
+        states: Dict[str, Dict] = {}
+        now = int(time.time())
+        for asin, data in fetched.items():
+            state = freshness.observe(vols.get(_vol_key(asin)), data)
+            states[_vol_key(asin)] = state
+            raw, extra = raws[asin]
+            entries[asin] = {"parser": PARSER_VERSION, "raw": raw, "extra": extra, "data": data,
+                             "exp": now + freshness.ttl_seconds(state)}
+        _write_entries(entries)
+        cache_set_many(states, ttl_seconds=freshness.VOL_TTL_SECONDS)
+        price_history.save_many(new_hists)
+    except Exception as cache_error:
+        # Restituisci i dati anche se la cache fallisce
+        print(f"[keepa_new] Cache error for batch of {len(fetched)}: {cache_error}")
+    _mark_negative(negative)
+    # Keepa ha risposto: azzera il backoff di chi non è più in errore
+    answered = [a for a in chunk if negative.get(a) != NEG_ERROR]
+    try:
+        cache_delete_many(_err_key(a) for a in answered)
+    except Exception as cache_error:
+        print(f"[keepa_new] Cache error resetting backoff: {cache_error}")
+    return fetched, []
+
+def enrich_many(asins: List[str]) -> Dict[str, Dict]:
+    """
+    Arricchisce più ASIN con una sola richiesta Keepa per blocco (max 100).
+    Prima legge la cache, poi interroga Keepa solo per gli ASIN mancanti
+    e salva ogni risultato in cache. Restituisce {asin: dati} con i soli
+    ASIN per cui abbiamo dati utili.
+    """
+    if not USE_KEEPA or not KEEPA_API_KEY:
+        print(f"[keepa_new] Disabled: USE_KEEPA={USE_KEEPA}, has_key={bool(KEEPA_API_KEY)}")
+        return {}
+
+    out, blocked = lookup_cache(asins)
+    out.update(fetch_many([a for a in asins if a not in out and a not in blocked]))
+    return out
+
+def enrich_with_keepa(asin: str) -> Optional[Dict]:
+    """
+    Nuovo parser Keepa che usa stats_parsed.
+    Bypassa il problema di cache del vecchio file.
+    """
+    return enrich_many([asin]).get(asin)
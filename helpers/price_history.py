@@ -0,0 +1,178 @@
+import base64
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+import numpy as np
+from config import PRICE_HISTORY_DAYS, PRICE_HISTORY_FILE
+from .redis_store import get_client, cache_get_many, cache_set_many
+
+# Storico prezzi locale per ASIN: due array NumPy (minuti unix, prezzo in
+# centesimi, -1 = non disponibile) salvati in redis_store come base64.
+# Si aggiorna a ogni risposta Keepa, così dal secondo fetch in poi basta
+# chiedere a Keepa solo gli ultimi giorni e le medie restano esatte.
+# Senza Upstash la cache L1 non sopravvive al processo: lo storico va su
+# PRICE_HISTORY_FILE (come DEDUP_FILE per il dedup), altrimenti si perde.
+
+Hist = Tuple[np.ndarray, np.ndarray, int]  # (t, p, minuto dell'ultimo fetch)
+
+KEEPA_TIME_OFFSET_MIN = 21564000  # minuti Keepa -> minuti unix
+STATS_DAYS = 90
+DAYS_BUCKETS = (7, 30, STATS_DAYS)  # finestre `days` chieste a Keepa
+
+def _key(asin: str) -> str:
+    return f"ph:{asin}"
+
+def _now_min() -> int:
+    return int(time.time() // 60)
+
+def _encode(hist: Hist) -> Dict:
+    t, p, ts = hist
+    return {
+        "t": base64.b64encode(t.astype("<i4").tobytes()).decode("ascii"),
+        "p": base64.b64encode(p.astype("<i4").tobytes()).decode("ascii"),
+        "ts": ts,
+    }
+
+def _decode(raw: Optional[Dict]) -> Optional[Hist]:
+    if not raw:
+        return None
+    try:
+        t = np.frombuffer(base64.b64decode(raw["t"]), dtype="<i4").astype(np.int64)
+        p = np.frombuffer(base64.b64decode(raw["p"]), dtype="<i4").astype(np.int64)
+        return t, p, int(raw["ts"])
+    except (KeyError, ValueError, TypeError) as e:
+        print(f"[price_history] Corrupt entry dropped: {type(e).__name__}: {e}")
+        return None
+
+_disk: Optional[Dict[str, Dict]] = None
+_disk_lock = threading.Lock()
+
+def _disk_store() -> Optional[Dict[str, Dict]]:
+    """Storico su file se Upstash non è configurato e PRICE_HISTORY_FILE è impostato."""
+    global _disk
+    if not PRICE_HISTORY_FILE or get_client() is not None:
+        return None
+    with _disk_lock:
+        if _disk is None:
+            _disk = {}
+            if os.path.exists(PRICE_HISTORY_FILE):
+                try:
+                    with open(PRICE_HISTORY_FILE, "r", encoding="utf-8") as f:
+                        _disk = json.load(f)
+                except Exception as e:
+                    print(f"[price_history] History file unreadable ({PRICE_HISTORY_FILE}): {e}")
+    return _disk
+
+def _save_disk(store: Dict[str, Dict]):
+    # scarta gli ASIN non aggiornati da PRICE_HISTORY_DAYS, come farebbe la TTL
+    cutoff = _now_min() - PRICE_HISTORY_DAYS * 1440
+    for key in [k for k, v in store.items() if v.get("ts", 0) < cutoff]:
+        del store[key]
+    tmp = f"{PRICE_HISTORY_FILE}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(store, f)
+        os.replace(tmp, PRICE_HISTORY_FILE)
+    except Exception as e:
+        print(f"[price_history] History file not saved ({PRICE_HISTORY_FILE}): {e}")
+
+def load_many(asins: Iterable[str]) -> Dict[str, Hist]:
+    store = _disk_store()
+    if store is not None:
+        with _disk_lock:
+            raw = {_key(a): store[_key(a)] for a in asins if _key(a) in store}
+    else:
+        raw = cache_get_many(_key(a) for a in asins)
+    out: Dict[str, Hist] = {}
+    for key, value in raw.items():
+        hist = _decode(value)
+        if hist is not None:
+            out[key[len("ph:"):]] = hist
+    return out
+
+def save_many(hists: Dict[str, Hist]):
+    if not hists:
+        return
+    encoded = {_key(a): _encode(h) for a, h in hists.items()}
+    store = _disk_store()
+    if store is not None:
+        with _disk_lock:
+            store.update(encoded)
+            _save_disk(store)
+    else:
+        cache_set_many(encoded, ttl_seconds=PRICE_HISTORY_DAYS * 24 * 3600)
+
+def from_keepa(item: Dict, now: Optional[int] = None) -> Hist:
+    """
+    Serie NEW (o AMAZON se manca) dal campo `csv` grezzo di un prodotto Keepa.
+    Serie vuota se il prezzo non è cambiato nella finestra richiesta.
+    """
+    csv = item.get("csv") or []
+    series = next((csv[i] for i in (1, 0) if len(csv) > i and csv[i]), [])
+    pairs = np.asarray(series[:len(series) // 2 * 2], dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0] + KEEPA_TIME_OFFSET_MIN, pairs[:, 1], now or _now_min()
+
+def merge(old: Optional[Hist], new: Optional[Hist]) -> Optional[Hist]:
+    """
+    Unisce la risposta Keepa (finestra recente) allo storico: i punti nuovi
+    sostituiscono quelli vecchi dal loro primo timestamp in poi. Tiene
+    PRICE_HISTORY_DAYS più l'ultimo punto prima del taglio (prezzo in vigore).
+    """
+    if old is None or new is None:
+        hist = new or old
+    elif not len(new[0]):
+        hist = (old[0], old[1], new[2])
+    else:
+        keep = old[0] < new[0][0]
+        hist = (np.concatenate([old[0][keep], new[0]]), np.concatenate([old[1][keep], new[1]]), new[2])
+    if hist is None:
+        return None
+    t, p, ts = hist
+    start = max(int(np.searchsorted(t, ts - PRICE_HISTORY_DAYS * 1440, side="right")) - 1, 0)
+    return t[start:], p[start:], ts
+
+def days_needed(hist: Optional[Hist], now: Optional[int] = None) -> int:
+    """Finestra `days` da chiedere a Keepa: solo i giorni dopo l'ultimo fetch."""
+    if hist is None:
+        return STATS_DAYS
+    gap = ((now or _now_min()) - hist[2]) / 1440.0 + 1
+    return next((d for d in DAYS_BUCKETS if gap <= d), STATS_DAYS)
+
+def summary(hist: Optional[Hist], days: int = STATS_DAYS, now: Optional[int] = None) -> Dict:
+    """
+    Statistiche pesate sul tempo negli ultimi `days` giorni (in euro):
+    media, minimo, massimo, 25° percentile e da quanti giorni il prezzo
+    attuale è il più basso. {} se lo storico non ha prezzi validi.
+    """
+    if hist is None or not len(hist[0]):
+        return {}
+    t, p, _ = hist
+    now = now or _now_min()
+    start = now - days * 1440
+
+    i = max(int(np.searchsorted(t, start, side="right")) - 1, 0)
+    seg_t = np.maximum(t[i:], start)
+    seg_p = p[i:]
+    dur = np.diff(np.append(seg_t, now))
+    ok = (seg_p > 0) & (dur > 0)
+    if not ok.any():
+        return {}
+    prices, weights = seg_p[ok], dur[ok]
+    order = np.argsort(prices, kind="stable")
+    cum = np.cumsum(weights[order])
+    p25 = prices[order][int(np.searchsorted(cum, 0.25 * cum[-1]))]
+
+    out = {
+        "avg_90": round(float(np.average(prices, weights=weights)) / 100, 2),
+        "min_price": round(float(prices.min()) / 100, 2),
+        "max_price": round(float(prices.max()) / 100, 2),
+        "price_p25_90": round(float(p25) / 100, 2),
+    }
+    # "Prezzo più basso da N giorni": ultimo punto precedente con prezzo <= attuale
+    if p[-1] > 0:
+        lower = np.flatnonzero((p[:-1] > 0) & (p[:-1] <= p[-1]))
+        since = t[lower[-1] + 1] if len(lower) else t[0]
+        out["lowest_in_days"] = int((now - since) // 1440)
+    return out
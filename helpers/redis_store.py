@@ -1,51 +1,365 @@
-﻿import json, time
-from typing import Optional, List, Dict
+﻿import hashlib, heapq, json, math, os, time, threading
+from collections import OrderedDict
+from typing import Optional, List, Dict, Iterable, Set
 try:
     from upstash_redis import Redis
 except Exception:
     Redis = None
-from config import UPSTASH_REDIS_URL, UPSTASH_REDIS_TOKEN, DEDUP_DAYS
+from config import (
+    UPSTASH_REDIS_URL, UPSTASH_REDIS_TOKEN, CACHE_L1_SIZE,
+    DEDUP_DAYS, DEDUP_FILE, QUEUE_MAX_LEN, QUEUE_TTL_HOURS, DEDUP_BACKEND, DEDUP_BLOOM_CAPACITY, DEDUP_BLOOM_FPR
+)
 
-_memory = {"dedup": set(), "cache": {}, "metrics": []}
+_memory = {"metrics": [], "queues": {}}
+
+# Client condiviso per tutto il processo (creato alla prima richiesta)
+_client = None
+_client_ready = False
+_client_lock = threading.Lock()
 
 def get_client() -> Optional["Redis"]:
-    if UPSTASH_REDIS_URL and UPSTASH_REDIS_TOKEN and Redis:
-        return Redis(url=UPSTASH_REDIS_URL, token=UPSTASH_REDIS_TOKEN)
-    return None
+    global _client, _client_ready
+    if not _client_ready:
+        with _client_lock:
+            if not _client_ready:
+                if UPSTASH_REDIS_URL and UPSTASH_REDIS_TOKEN and Redis:
+                    _client = Redis(url=UPSTASH_REDIS_URL, token=UPSTASH_REDIS_TOKEN)
+                _client_ready = True
+    return _client
 
 # ----- DEDUP -----
+class DedupIndex:
+    """
+    Indice dedup in memoria per quando Upstash non è configurato:
+    dict ASIN -> scadenza per lookup O(1) e min-heap di scadenze per
+    eliminare le voci vecchie in modo lazy. Se `path` è impostato lo stato
+    viene salvato su file, così sopravvive ai riavvii.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._expiry: Dict[str, float] = {}
+        self._heap: List[tuple] = []
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"[redis_store] Dedup file unreadable ({self.path}): {e}")
+            return
+        now = time.time()
+        for asin, exp in data.items():
+            if exp > now:
+                self._expiry[asin] = exp
+                heapq.heappush(self._heap, (exp, asin))
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._expiry, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"[redis_store] Dedup file not saved ({self.path}): {e}")
+
+    def _purge(self, now: float):
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            exp, asin = heapq.heappop(heap)
+            # la voce nell'heap può essere superata da un mark più recente
+            if self._expiry.get(asin) == exp:
+                del self._expiry[asin]
+
+    def check_many(self, asins: Iterable[str]) -> Set[str]:
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            return {a for a in asins if self._expiry.get(a, 0) > now}
+
+    def mark_many(self, asins: Iterable[str], ttl_seconds: int):
+        exp = time.time() + ttl_seconds
+        with self._lock:
+            for asin in asins:
+                self._expiry[asin] = exp
+                heapq.heappush(self._heap, (exp, asin))
+            self._purge(time.time())
+            self._save()
+
+_dedup = DedupIndex(DEDUP_FILE)
+
+# Backend "bloom": un Bloom filter al giorno in una bitmap Redis. La finestra
+# DEDUP_DAYS è l'unione degli ultimi DEDUP_DAYS+1 filtri giornalieri; ogni
+# filtro è dimensionato per DEDUP_BLOOM_CAPACITY ASIN/giorno con un tasso di
+# falsi positivi tale che l'unione resti sotto DEDUP_BLOOM_FPR.
+def _bloom_params(capacity: int, fpr: float):
+    n = max(1, capacity)
+    m = int(math.ceil(-n * math.log(fpr) / (math.log(2) ** 2)))
+    k = max(1, int(round(m / n * math.log(2))))
+    return m, k
+
+_BLOOM_DAYS = DEDUP_DAYS + 1
+_BLOOM_BITS, _BLOOM_HASHES = _bloom_params(DEDUP_BLOOM_CAPACITY, DEDUP_BLOOM_FPR / _BLOOM_DAYS)
+
+def _bloom_offsets(asin: str) -> List[int]:
+    # double hashing (Kirsch-Mitzenmacher) su un solo digest
+    digest = hashlib.sha256(asin.encode("utf-8")).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:16], "big") | 1
+    return [(h1 + i * h2) % _BLOOM_BITS for i in range(_BLOOM_HASHES)]
+
+def _bloom_keys(now: Optional[float] = None) -> List[str]:
+    """Chiavi dei filtri giornalieri (UTC), dal più recente."""
+    day = int((now or time.time()) // 86400)
+    return [f"dedup_bloom:{d}" for d in range(day, day - _BLOOM_DAYS, -1)]
+
+# Upstash fattura a comando: un solo BITFIELD per filtro giornaliero con
+# tutti gli offset (GET/SET u1) invece di un GETBIT/SETBIT per bit.
+def _bloom_mark(r, asins: List[str]):
+    key = _bloom_keys()[0]
+    cmd = ["BITFIELD", key]
+    for asin in asins:
+        for off in _bloom_offsets(asin):
+            cmd += ["SET", "u1", off, 1]
+    pipe = r.pipeline()
+    pipe.execute(cmd)
+    pipe.expire(key, (_BLOOM_DAYS + 1) * 86400)
+    pipe.exec()
+
+def _bloom_check(r, asins: List[str]) -> Set[str]:
+    keys = _bloom_keys()
+    offsets = [off for asin in asins for off in _bloom_offsets(asin)]
+    get_cmd = [x for off in offsets for x in ("GET", "u1", off)]
+    pipe = r.pipeline()
+    for key in keys:
+        pipe.execute(["BITFIELD_RO", key] + get_cmd)
+    seen: Set[str] = set()
+    for bits in pipe.exec():
+        for i, asin in enumerate(asins):
+            if all(bits[i * _BLOOM_HASHES:(i + 1) * _BLOOM_HASHES]):
+                seen.add(asin)
+    return seen
+
 def mark_dedup(asin: str):
+    mark_dedup_many([asin])
+
+def mark_dedup_many(asins: Iterable[str]):
+    asins = list(dict.fromkeys(asins))
+    if not asins:
+        return
     r = get_client()
-    key = f"dedup:{asin}"
     ttl = DEDUP_DAYS*24*3600
-    if r:
-        r.set(key, "1", ex=ttl)
+    if r and DEDUP_BACKEND == "bloom":
+        _bloom_mark(r, asins)
+    elif r:
+        pipe = r.pipeline()
+        for asin in asins:
+            pipe.set(f"dedup:{asin}", "1", ex=ttl)
+        pipe.exec()
     else:
-        _memory["dedup"].add((asin, time.time()+ttl))
+        _dedup.mark_many(asins, ttl)
 
 def seen_recently(asin: str) -> bool:
+    return asin in seen_recently_many([asin])
+
+def seen_recently_many(asins: Iterable[str]) -> Set[str]:
+    """Restituisce gli ASIN già pubblicati negli ultimi DEDUP_DAYS (una sola chiamata)."""
+    asins = list(dict.fromkeys(asins))
+    if not asins:
+        return set()
     r = get_client()
-    key = f"dedup:{asin}"
+    if r and DEDUP_BACKEND == "bloom":
+        return _bloom_check(r, asins)
     if r:
-        return r.get(key) is not None
-    now = time.time()
-    _memory["dedup"] = {(a,exp) for (a,exp) in _memory["dedup"] if exp > now}
-    return any(a == asin for a,_ in _memory["dedup"])
+        vals = r.mget(*[f"dedup:{a}" for a in asins])
+        return {a for a, v in zip(asins, vals or []) if v is not None}
+    return _dedup.check_many(asins)
 
 # ----- CACHE (generic) -----
+class LRUCache:
+    """
+    Cache L1 in processo: LRU limitata a `maxsize` chiavi, con scadenza per
+    chiave. Conserva il JSON già serializzato, così i valori letti da L1 e
+    da Upstash (L2) sono identici e i chiamanti ricevono sempre copie nuove.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, raw: str, ttl_seconds: Optional[int]):
+        expires = time.time() + ttl_seconds if ttl_seconds and ttl_seconds > 0 else None
+        with self._lock:
+            self._data[key] = (raw, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def expires_at(self, key: str) -> Optional[float]:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry[1] if entry is not None else None
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+_l1 = LRUCache(CACHE_L1_SIZE)
+_l2_stats = {"hits": 0, "misses": 0}
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    """Contatori hit/miss per livello (L1 = memoria, L2 = Upstash)."""
+    return {
+        "l1": {"hits": _l1.hits, "misses": _l1.misses, "size": len(_l1._data)},
+        "l2": dict(_l2_stats),
+    }
+
+def _l2_read(r, keys: List[str]) -> Dict[str, str]:
+    """MGET + TTL in un'unica pipeline; riempie L1 con la scadenza residua."""
+    pipe = r.pipeline()
+    pipe.mget(*keys)
+    for key in keys:
+        pipe.ttl(key)
+    res = pipe.exec()
+    vals, ttls = res[0] or [], res[1:]
+    found: Dict[str, str] = {}
+    for key, raw, ttl in zip(keys, vals, ttls):
+        if raw:
+            _l2_stats["hits"] += 1
+            _l1.set(key, raw, ttl if ttl and ttl > 0 else None)
+            found[key] = raw
+        else:
+            _l2_stats["misses"] += 1
+    return found
+
 def cache_get(key: str):
+    return cache_get_many([key]).get(key)
+
+def cache_set(key: str, value, ttl_seconds: int):
+    cache_set_many({key: value}, ttl_seconds)
+
+def cache_get_many(keys: Iterable[str]) -> Dict[str, object]:
+    """
+    Legge più chiavi: prima L1, poi le mancanti da Upstash con una sola
+    pipeline. Restituisce solo le chiavi presenti.
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return {}
+    raw: Dict[str, str] = {}
+    missing: List[str] = []
+    for key in keys:
+        hit = _l1.get(key)
+        if hit is not None:
+            raw[key] = hit
+        else:
+            missing.append(key)
+    r = get_client()
+    if r and missing:
+        raw.update(_l2_read(r, missing))
+    return {k: json.loads(v) for k, v in raw.items() if v}
+
+def cache_set_many(items: Dict[str, object], ttl_seconds: int):
+    """Scrive più chiavi con la stessa TTL: L1 e Upstash (un'unica pipeline)."""
+    if not items:
+        return
+    encoded = {key: json.dumps(value) for key, value in items.items()}
+    for key, raw in encoded.items():
+        _l1.set(key, raw, ttl_seconds)
     r = get_client()
     if r:
-        val = r.get(key)
-        return json.loads(val) if val else None
-    return _memory["cache"].get(key)
+        pipe = r.pipeline()
+        for key, raw in encoded.items():
+            pipe.set(key, raw, ex=ttl_seconds)
+        pipe.exec()
 
-def cache_set(key: str, value, ttl_seconds: int):
+def cache_ttl_many(keys: Iterable[str]) -> Dict[str, Optional[int]]:
+    """
+    TTL residua in secondi (None = senza scadenza) di chiavi appena lette
+    con cache_get_many: la lettura ha già messo in L1 la scadenza di Upstash.
+    """
+    out: Dict[str, Optional[int]] = {}
+    now = time.time()
+    for key in keys:
+        expires = _l1.expires_at(key)
+        out[key] = max(1, int(expires - now)) if expires is not None else None
+    return out
+
+def cache_delete_many(keys: Iterable[str]):
+    keys = list(keys)
+    if not keys:
+        return
+    for key in keys:
+        _l1.delete(key)
+    r = get_client()
+    if r:
+        r.delete(*keys)
+
+# ----- QUEUES (con priorità) -----
+def queue_add(name: str, items: Dict[str, float]):
+    """
+    Aggiunge membri a una coda con priorità; un membro già presente tiene la
+    priorità più alta. La coda resta entro QUEUE_MAX_LEN membri (si scartano
+    i meno prioritari) e scade dopo QUEUE_TTL_HOURS senza aggiunte.
+    """
+    if not items:
+        return
     r = get_client()
     if r:
-        r.set(key, json.dumps(value), ex=ttl_seconds)
+        key = f"q:{name}"
+        pipe = r.pipeline()
+        pipe.zadd(key, items, gt=True)
+        pipe.zremrangebyrank(key, 0, -(QUEUE_MAX_LEN + 1))
+        pipe.expire(key, QUEUE_TTL_HOURS * 3600)
+        pipe.exec()
     else:
-        _memory["cache"][key] = value  # no TTL in-memory
+        q = _memory["queues"].setdefault(name, {})
+        for member, prio in items.items():
+            q[member] = max(prio, q.get(member, prio))
+        if len(q) > QUEUE_MAX_LEN:
+            for member in sorted(q, key=q.get)[:len(q) - QUEUE_MAX_LEN]:
+                del q[member]
+
+def queue_pop(name: str, count: int) -> List[str]:
+    """Estrae fino a `count` membri, dalla priorità più alta."""
+    if count <= 0:
+        return []
+    r = get_client()
+    if r:
+        return [member for member, _ in (r.zpopmax(f"q:{name}", count) or [])]
+    q = _memory["queues"].get(name, {})
+    top = sorted(q, key=q.get, reverse=True)[:count]
+    for member in top:
+        del q[member]
+    return top
+
+def queue_len(name: str) -> int:
+    r = get_client()
+    if r:
+        return int(r.zcard(f"q:{name}") or 0)
+    return len(_memory["queues"].get(name, {}))
 
 # ----- METRICS (weekly) -----
 def metrics_add(week_key: str, item: Dict, score: float):
@@ -58,8 +372,11 @@ def metrics_add(week_key: str, item: Dict, score: float):
         "ts": int(time.time())
     }
     if r:
-        r.zadd(f"wk:{week_key}:score", {json.dumps(data): score})
-        r.zadd(f"wk:{week_key}:discount", {json.dumps(data): disc})
+        member = json.dumps(data)
+        pipe = r.pipeline()
+        pipe.zadd(f"wk:{week_key}:score", {member: score})
+        pipe.zadd(f"wk:{week_key}:discount", {member: disc})
+        pipe.exec()
     else:
         _memory["metrics"].append(data)
 
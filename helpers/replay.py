@@ -0,0 +1,455 @@
+import json
+import os
+import pickle
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+# Registrazione/replay offline dei servizi esterni (PA-API, Keepa, Upstash)
+# per misurare la pipeline senza rete: vedi bench_pipeline.py.
+#
+# - PA-API: risposte di SearchItems per (keyword, pagina) e item di GetItems per ASIN
+# - Keepa: prodotti per ASIN (il replay regge batch diversi da quelli
+#   registrati), categorie radice e saldo token iniziale
+# - Redis: log delle operazioni; in replay le letture fatte prima di ogni
+#   scrittura ricostruiscono lo stato iniziale di un FakeRedis in memoria
+
+PAAPI_FILE = "paapi.pkl"
+KEEPA_FILE = "keepa.pkl"
+REDIS_FILE = "redis.json"
+
+# Chiamate esterne per servizio (paapi, keepa, redis, telegram)
+calls: Counter = Counter()
+
+class _ReplayedError(Exception):
+    pass
+
+def _error(name: str, message: str) -> Exception:
+    # selector/amazon/keepa_new riconoscono gli errori per nome e messaggio
+    return type(name, (_ReplayedError,), {})(message)
+
+def _jsonable(value):
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return value
+
+# ----- PA-API -----
+
+class PaapiRecorder:
+    """Avvolge amazon._search_items/_get_items e salva risposte (o errori) e durata."""
+
+    def __init__(self, search_fn, get_items_fn):
+        self.search_fn = search_fn
+        self.get_items_fn = get_items_fn
+        self.searches: Dict[str, Dict] = {}
+        self.items: Dict[str, Dict] = {}
+
+    def search_items(self, api, **kwargs):
+        calls["paapi"] += 1
+        key = json.dumps([kwargs.get("keywords"), kwargs.get("item_page", 1)])
+        start = time.perf_counter()
+        try:
+            res = self.search_fn(api, **kwargs)
+        except Exception as e:
+            self.searches[key] = {"error": (type(e).__name__, str(e)), "elapsed": time.perf_counter() - start}
+            raise
+        self.searches[key] = {"result": res, "elapsed": time.perf_counter() - start}
+        return res
+
+    def get_items(self, api, asins: List[str]):
+        calls["paapi"] += 1
+        start = time.perf_counter()
+        items = self.get_items_fn(api, asins)
+        elapsed = (time.perf_counter() - start) / max(1, len(asins))
+        for it in items or []:
+            self.items[getattr(it, "asin", None)] = {"result": it, "elapsed": elapsed}
+        return items
+
+    def dump(self, path: str):
+        with open(os.path.join(path, PAAPI_FILE), "wb") as f:
+            pickle.dump({"searches": self.searches, "items": self.items}, f)
+
+class NoLimiter:
+    """Al posto di amazon._limiter in replay: senza rete non c'è TPS da rispettare."""
+
+    def acquire(self):
+        pass
+
+    def on_success(self):
+        pass
+
+    def on_throttle(self):
+        pass
+
+class PaapiReplay:
+    def __init__(self, path: str, latency: bool = False):
+        with open(os.path.join(path, PAAPI_FILE), "rb") as f:
+            data = pickle.load(f)
+        self.searches, self.items = data["searches"], data["items"]
+        self.latency = latency
+        self.unrecorded = 0
+
+    def _sleep(self, elapsed: float):
+        if self.latency and elapsed:
+            time.sleep(elapsed)
+
+    def search_items(self, api, **kwargs):
+        calls["paapi"] += 1
+        entry = self.searches.get(json.dumps([kwargs.get("keywords"), kwargs.get("item_page", 1)]))
+        if entry is None:
+            self.unrecorded += 1
+            raise _error("ItemsNotFound", "No items have been found (not recorded)")
+        self._sleep(entry["elapsed"])
+        if "error" in entry:
+            raise _error(*entry["error"])
+        return entry["result"]
+
+    def get_items(self, api, asins: List[str]):
+        calls["paapi"] += 1
+        found = [self.items[a] for a in asins if a in self.items]
+        self.unrecorded += len(asins) - len(found)
+        self._sleep(sum(e["elapsed"] for e in found))
+        return [e["result"] for e in found]
+
+# ----- Keepa -----
+
+class KeepaRecorder:
+    """Proxy del client keepa.Keepa: registra prodotti, categorie e saldo token."""
+
+    def __init__(self, client, tokens_per_asin: int):
+        self._client = client
+        self.products: Dict[str, Dict] = {}
+        self.categories = None
+        # keepa conosce il saldo solo dopo la prima risposta: si registra lì
+        self.tokens_start = None
+        self.refill_rate = None
+        self.tokens_per_asin = tokens_per_asin
+        self.elapsed_per_asin: List[float] = []
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _record_status(self, spent: int = 0):
+        status = getattr(self._client, "status", None)
+        rate = status.get("refillRate") if isinstance(status, dict) else getattr(status, "refillRate", None)
+        if rate is not None:
+            self.refill_rate = rate
+        if self.tokens_start is None and rate is not None:
+            # saldo prima della prima richiesta registrata
+            self.tokens_start = self._client.tokens_left + spent
+
+    def query(self, items, **kwargs):
+        calls["keepa"] += 1
+        start = time.perf_counter()
+        products = self._client.query(items, **kwargs)
+        asins = [items] if isinstance(items, str) else list(items)
+        self.elapsed_per_asin.append((time.perf_counter() - start) / max(1, len(asins)))
+        self._record_status(len(asins) * self.tokens_per_asin)
+        for p in products or []:
+            if isinstance(p, dict) and p.get("asin"):
+                self.products[p["asin"]] = p
+        return products
+
+    def category_lookup(self, category_id, **kwargs):
+        calls["keepa"] += 1
+        self.categories = self._client.category_lookup(category_id, **kwargs)
+        return self.categories
+
+    def update_status(self):
+        calls["keepa"] += 1
+        status = self._client.update_status()
+        self._record_status()
+        return status
+
+    def dump(self, path: str):
+        elapsed = sum(self.elapsed_per_asin) / len(self.elapsed_per_asin) if self.elapsed_per_asin else 0.0
+        with open(os.path.join(path, KEEPA_FILE), "wb") as f:
+            pickle.dump({
+                "products": self.products, "categories": self.categories,
+                "tokens_left": self.tokens_start, "refill_rate": self.refill_rate,
+                "elapsed_per_asin": elapsed,
+            }, f)
+
+class KeepaReplay:
+    """Client Keepa finto: prodotti registrati per ASIN, token scalati per ASIN richiesto."""
+
+    def __init__(self, path: str, tokens_per_asin: int, latency: bool = False):
+        with open(os.path.join(path, KEEPA_FILE), "rb") as f:
+            data = pickle.load(f)
+        self.products = data["products"]
+        self.categories = data["categories"]
+        self.tokens_left = data["tokens_left"]
+        self.status = {"refillRate": data["refill_rate"]} if data["refill_rate"] is not None else None
+        self.elapsed_per_asin = data["elapsed_per_asin"] if latency else 0.0
+        self.tokens_per_asin = tokens_per_asin
+        self.unrecorded = 0
+
+    def query(self, items, wait: bool = True, **kwargs):
+        calls["keepa"] += 1
+        asins = [items] if isinstance(items, str) else list(items)
+        cost = len(asins) * self.tokens_per_asin
+        if self.tokens_left is not None:
+            if not wait and self.tokens_left < 0:
+                raise _error("RuntimeError", "NOT_ENOUGH_TOKEN")
+            self.tokens_left -= cost
+        if self.elapsed_per_asin:
+            time.sleep(self.elapsed_per_asin * len(asins))
+        found = [self.products[a] for a in asins if a in self.products]
+        self.unrecorded += len(asins) - len(found)
+        return found
+
+    def category_lookup(self, category_id, **kwargs):
+        calls["keepa"] += 1
+        if self.categories is None:
+            raise _error("RuntimeError", "categories not recorded")
+        return self.categories
+
+    def update_status(self):
+        calls["keepa"] += 1
+        return self.status
+
+# ----- Redis -----
+
+READ_OPS = {"mget", "ttl", "bitfield_ro", "zpopmax", "zrevrange", "zcard", "get"}
+
+class RedisRecorder:
+    """Proxy del client upstash_redis: registra ogni comando con argomenti e risultato."""
+
+    def __init__(self, client, log: Optional[List] = None):
+        self._client = client
+        self.log = [] if log is None else log
+
+    def __getattr__(self, name):
+        fn = getattr(self._client, name)
+
+        def _wrapped(*args, **kwargs):
+            calls["redis"] += 1
+            res = fn(*args, **kwargs)
+            self.log.append([name, _jsonable(args), _jsonable(kwargs), _jsonable(res)])
+            return res
+        return _wrapped
+
+    def pipeline(self):
+        calls["redis"] += 1
+        return _RecordingPipeline(self._client.pipeline(), self.log)
+
+    def dump(self, path: str):
+        with open(os.path.join(path, REDIS_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.log, f)
+
+class _RecordingPipeline:
+    def __init__(self, pipe, log: List):
+        self._pipe = pipe
+        self._log = log
+        self._queued: List = []
+
+    def __getattr__(self, name):
+        fn = getattr(self._pipe, name)
+
+        def _queue(*args, **kwargs):
+            self._queued.append([name, _jsonable(args), _jsonable(kwargs)])
+            return fn(*args, **kwargs)
+        return _queue
+
+    def exec(self):
+        res = self._pipe.exec()
+        for (name, args, kwargs), r in zip(self._queued, res or []):
+            self._log.append([name, args, kwargs, _jsonable(r)])
+        return res
+
+class FakeRedis:
+    """Sottoinsieme di upstash_redis.Redis usato da redis_store, tutto in memoria."""
+
+    def __init__(self):
+        self.values: Dict[str, str] = {}
+        self.bits: Dict[str, set] = {}
+        self.zsets: Dict[str, Dict[str, float]] = {}
+        self.expires: Dict[str, float] = {}
+
+    def _alive(self, key: str) -> bool:
+        exp = self.expires.get(key)
+        if exp is not None and exp <= time.time():
+            # scadenza lato server: non è una chiamata in più
+            del self.expires[key]
+            for store in (self.values, self.bits, self.zsets):
+                store.pop(key, None)
+            return False
+        return True
+
+    def set(self, key, value, ex=None):
+        calls["redis"] += 1
+        self.values[key] = value
+        if ex:
+            self.expires[key] = time.time() + ex
+        else:
+            self.expires.pop(key, None)
+        return True
+
+    def get(self, key):
+        calls["redis"] += 1
+        return self.values.get(key) if self._alive(key) else None
+
+    def mget(self, *keys):
+        calls["redis"] += 1
+        return [self.values.get(k) if self._alive(k) else None for k in keys]
+
+    def ttl(self, key):
+        calls["redis"] += 1
+        if not self._alive(key) or not (key in self.values or key in self.bits or key in self.zsets):
+            return -2
+        exp = self.expires.get(key)
+        return int(exp - time.time()) if exp is not None else -1
+
+    def expire(self, key, seconds):
+        calls["redis"] += 1
+        self.expires[key] = time.time() + seconds
+        return 1
+
+    def delete(self, *keys):
+        calls["redis"] += 1
+        n = 0
+        for key in keys:
+            self.expires.pop(key, None)
+            n += sum(store.pop(key, None) is not None for store in (self.values, self.bits, self.zsets))
+        return n
+
+    def execute(self, command: List):
+        # comandi grezzi: redis_store li usa solo per BITFIELD (campi u1)
+        calls["redis"] += 1
+        name, key, ops = command[0].upper(), command[1], command[2:]
+        if name not in ("BITFIELD", "BITFIELD_RO"):
+            raise NotImplementedError(name)
+        bits = self.bits.get(key, set()) if self._alive(key) else set()
+        out, i = [], 0
+        while i < len(ops):
+            op, off = ops[i].upper(), int(ops[i + 2])
+            out.append(1 if off in bits else 0)
+            if op == "SET":
+                bits = self.bits.setdefault(key, bits)
+                (bits.add if ops[i + 3] else bits.discard)(off)
+                i += 4
+            else:
+                i += 3
+        return out
+
+    def zadd(self, key, scores: Dict[str, float], gt: bool = False):
+        calls["redis"] += 1
+        zset = self.zsets.setdefault(key, {})
+        added = 0
+        for member, score in scores.items():
+            if member not in zset:
+                added += 1
+                zset[member] = score
+            elif not gt or score > zset[member]:
+                zset[member] = score
+        return added
+
+    def _sorted(self, key):
+        zset = self.zsets.get(key, {}) if self._alive(key) else {}
+        return sorted(zset.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+
+    def zremrangebyrank(self, key, start, stop):
+        calls["redis"] += 1
+        ranked = self._sorted(key)[::-1]  # dal punteggio più basso
+        n = len(ranked)
+        start, stop = (start + n if start < 0 else start), (stop + n if stop < 0 else stop)
+        for member, _ in ranked[max(0, start):stop + 1]:
+            del self.zsets[key][member]
+        return max(0, min(stop, n - 1) - max(0, start) + 1)
+
+    def zpopmax(self, key, count=1):
+        calls["redis"] += 1
+        top = self._sorted(key)[:count]
+        for member, _ in top:
+            del self.zsets[key][member]
+        return top
+
+    def zcard(self, key):
+        calls["redis"] += 1
+        return len(self._sorted(key))
+
+    def zrevrange(self, key, start, stop):
+        calls["redis"] += 1
+        members = [m for m, _ in self._sorted(key)]
+        return members[start:stop + 1 if stop >= 0 else None]
+
+    def pipeline(self):
+        return _FakePipeline(self)
+
+class _FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self._redis = redis
+        self._queued: List = []
+
+    def __getattr__(self, name):
+        def _queue(*args, **kwargs):
+            self._queued.append((name, args, kwargs))
+        return _queue
+
+    def exec(self):
+        # un'unica richiesta HTTP verso Upstash: conta come una chiamata
+        before = calls["redis"]
+        res = [getattr(self._redis, n)(*a, **kw) for n, a, kw in self._queued]
+        calls["redis"] = before + 1
+        return res
+
+def redis_from_log(path: str) -> FakeRedis:
+    """
+    FakeRedis con lo stato iniziale ricostruito dal log registrato: valgono
+    solo le letture fatte prima che il run scrivesse la stessa chiave.
+    """
+    with open(os.path.join(path, REDIS_FILE), encoding="utf-8") as f:
+        log = json.load(f)
+    fake = FakeRedis()
+    written = set()
+    for name, args, kwargs, res in log:
+        if name == "execute":
+            name, args = args[0][0].lower(), args[0][1:]
+        key = args[0] if args else None
+        if name not in READ_OPS:
+            written.update(args if name == "delete" else [key])
+            continue
+        if name == "mget":
+            for k, v in zip(args, res or []):
+                if v is not None and k not in written and k not in fake.values:
+                    fake.values[k] = v
+        elif key in written:
+            continue
+        elif name == "get" and res is not None:
+            fake.values.setdefault(key, res)
+        elif name == "ttl" and isinstance(res, int) and res > 0:
+            fake.expires.setdefault(key, time.time() + res)
+        elif name == "bitfield_ro":
+            offsets = args[3::3]
+            fake.bits.setdefault(key, set()).update(o for o, bit in zip(offsets, res or []) if bit)
+        elif name == "zpopmax":
+            fake.zsets.setdefault(key, {}).update({m: s for m, s in res or []})
+        elif name == "zrevrange":
+            zset = fake.zsets.setdefault(key, {})
+            for i, m in enumerate(res or []):
+                zset.setdefault(m, float(len(res) - i))
+    calls.clear()
+    return fake
+
+# ----- Telegram -----
+
+class FakeTelegram:
+    """Stand-in del client Telethon: conta e conserva i messaggi invece di inviarli."""
+
+    def __init__(self):
+        self.sent: List[Dict] = []
+
+    async def start(self, **kwargs):
+        return self
+
+    async def send_message(self, entity, message, **kwargs):
+        calls["telegram"] += 1
+        self.sent.append({"entity": entity, "message": message})
+
+    async def send_file(self, entity, file, caption=None, **kwargs):
+        calls["telegram"] += 1
+        self.sent.append({"entity": entity, "file": file, "message": caption})
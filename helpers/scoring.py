@@ -1,4 +1,10 @@
 ﻿import math
+import numpy as np
+
+DEFAULT_WEIGHTS = {
+    "discount":0.35, "rating":0.25, "trend":0.20,
+    "rank":0.10, "prime_buybox_bonus":0.10, "reviews_bonus":0.10
+}
 
 def clamp01(x): 
     return max(0.0, min(1.0, x))
@@ -32,10 +38,7 @@ def compute_brisly_score(discount_pct, stars, current_price, avg_90,
                          rank=None, total_in_cat=None,
                          is_prime=False, buybox_amazon=False,
                          n_reviews=0, weights=None):
-    w = weights or {
-        "discount":0.35, "rating":0.25, "trend":0.20,
-        "rank":0.10, "prime_buybox_bonus":0.10, "reviews_bonus":0.10
-    }
+    w = weights or DEFAULT_WEIGHTS
     s_discount = normalize_discount(discount_pct or 0)
     s_rating  = normalize_rating(stars or 4.0)
     s_trend   = trend_score(current_price, avg_90)
@@ -54,3 +57,66 @@ def compute_brisly_score(discount_pct, stars, current_price, avg_90,
     score01 = clamp01(base + bonus)
     score05 = round(score01 * 5 * 2) / 2.0
     return score05
+
+# ----- Versione vettoriale (NumPy) -----
+# Stesse operazioni, nello stesso ordine, di compute_brisly_score su colonne
+# intere: i risultati sono identici bit a bit. None vale come il
+# valore "mancante" della versione scalare.
+
+def _col(values, n=None):
+    if values is None:
+        return np.full(n, np.nan)
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+def _missing(x):
+    # equivalente di `not x` per numeri/None
+    return np.isnan(x) | (x == 0)
+
+def _flag(values, n):
+    if values is None:
+        return np.zeros(n, dtype=bool)
+    return np.array([bool(v) for v in values], dtype=bool)
+
+def compute_brisly_scores(discount_pct, stars, current_price, avg_90,
+                          rank=None, total_in_cat=None,
+                          is_prime=None, buybox_amazon=None,
+                          n_reviews=None, weights=None) -> np.ndarray:
+    """
+    compute_brisly_score su colonne (liste o array della stessa lunghezza):
+    restituisce un array di punteggi 0..5 a passi di 0.5.
+    """
+    w = weights or DEFAULT_WEIGHTS
+    pct = _col(discount_pct)
+    n = len(pct)
+    stars, cur, avg = _col(stars), _col(current_price), _col(avg_90)
+    rank, total, revs = _col(rank, n), _col(total_in_cat, n), _col(n_reviews, n)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s_discount = np.clip(np.where(_missing(pct), 0.0, pct) / 40.0, 0.0, 1.0)
+        s_rating = np.clip((np.where(_missing(stars), 4.0, stars) - 3.5) / 1.0, 0.0, 1.0)
+
+        no_trend = _missing(cur) | _missing(avg) | ~(avg > 0)
+        s_trend = np.where(no_trend, 0.5, np.clip(1.0 - (((cur - avg) / avg) / 0.20), 0.0, 1.0))
+
+        pctl = rank / total
+        s_rank = np.clip((0.50 - pctl) / 0.45, 0.0, 1.0)
+        s_rank = np.where(pctl <= 0.05, 1.0, np.where(pctl >= 0.50, 0.0, s_rank))
+        s_rank = np.where(_missing(rank) | _missing(total) | ~(total > 0), 0.5, s_rank)
+
+        # log10 come math.log10 (np.log10 può differire di 1 ulp), una volta per valore distinto
+        has_revs = ~_missing(revs) & (revs > 0)
+        uniq, inv = np.unique(np.where(has_revs, revs, 0.0), return_inverse=True)
+        logs = np.array([math.log10(v + 1) if v > 0 else 0.0 for v in uniq.tolist()])
+        s_reviews = np.where(has_revs, np.clip(logs[inv.reshape(-1)] / 3.0, 0.0, 1.0), 0.0)
+
+    bonus = np.where(_flag(is_prime, n) & _flag(buybox_amazon, n), w["prime_buybox_bonus"], 0.0)
+    bonus = bonus + np.minimum(w["reviews_bonus"], s_reviews)
+
+    base = (
+        w["discount"] * s_discount +
+        w["rating"]  * s_rating  +
+        w["trend"]   * s_trend   +
+        w["rank"]    * s_rank
+    )
+    score01 = np.clip(base + bonus, 0.0, 1.0)
+    return np.round(score01 * 5 * 2) / 2.0 + 0.0  # + 0.0: niente -0.0
@@ -1,12 +1,22 @@
-from typing import List, Dict
-from .amazon import search_candidates_for_keyword
+from typing import List, Dict, Optional
+from .amazon import search_candidates_for_keyword, refresh_items
 from .aliexpress import fetch_aliexpress_candidates
-from .keepa_new import enrich_with_keepa  # <-- CAMBIATO: usa il nuovo client
-from .redis_store import seen_recently, mark_dedup
+from .keepa_new import lookup_cache, fetch_many, DEFER_QUEUE  # <-- CAMBIATO: usa il nuovo client (batch)
+from .keepa_budget import (
+    PREFETCH_QUEUE, refresh_budget, record_budget, slot_allowance,
+    prefetch_allowance, queue_prefetch
+)
+from .redis_store import seen_recently_many, mark_dedup, cache_get, cache_set, queue_pop
 from .scoring import compute_brisly_score
-from config import KEYWORDS, MIN_DISCOUNT, KEEPA_MAX_ENRICH, AMZ_THROTTLE_MS
+from . import category_index
+from config import KEYWORDS, MIN_DISCOUNT, AMZ_CONCURRENCY
+import asyncio
+import heapq
 import time
 
+POOL_KEY = "pool:candidates"
+POOL_TTL_HOURS = 3  # il pool serve solo allo slot successivo
+
 DEFAULT_TAGS = {
     "tv": "Hisense SmartTV OLED 144Hz",
     "cuffie": "Cuffie Audio",
@@ -21,6 +31,30 @@ DEFAULT_TAGS = {
 def _keyword_tags(kw: str):
     return [t for t in DEFAULT_TAGS.get(kw.split()[0].lower(), "").split() if t]
 
+def _merge_key(c: Dict):
+    # Varianti (colore/taglia) dello stesso prodotto hanno lo stesso parent ASIN
+    return c.get("source"), c.get("parent_asin") or c["asin"]
+
+def merge_candidates(cands: List[Dict]) -> List[Dict]:
+    """
+    Unisce i duplicati tra keyword e le varianti dello stesso parent ASIN:
+    tiene la variante col prezzo più basso (a pari prezzo lo sconto più alto)
+    e unisce i tag delle keyword. Nessuna chiamata esterna.
+    """
+    best: Dict[tuple, Dict] = {}
+    tags: Dict[tuple, List[str]] = {}
+    for c in cands:
+        key = _merge_key(c)
+        tags.setdefault(key, []).extend(c.get("tags") or [])
+        cur = best.get(key)
+        if cur is None or (c["price_now"], -c.get("discount_pct", 0)) < (cur["price_now"], -cur.get("discount_pct", 0)):
+            best[key] = c
+    for key, c in best.items():
+        c["tags"] = list(dict.fromkeys(tags[key]))
+    if len(best) < len(cands):
+        print(f"[selector] Merged {len(cands) - len(best)} duplicate/variant candidates")
+    return list(best.values())
+
 def gather_candidates() -> List[Dict]:
     all_items: List[Dict] = []
     for kw in KEYWORDS:
@@ -28,59 +62,272 @@ def gather_candidates() -> List[Dict]:
         for it in items:
             it["tags"] = _keyword_tags(kw)
         all_items.extend(items)
-        time.sleep(AMZ_THROTTLE_MS / 1000.0)  # pausa anti-TooManyRequests
 
     # AliExpress (se attivo e quando integrato)
     all_items.extend(fetch_aliexpress_candidates())
-    return all_items
+    return merge_candidates(all_items)
 
-def enrich_and_rank(cands: List[Dict]) -> List[Dict]:
-    enriched: List[Dict] = []
-    keepa_calls = 0
-    
-    for c in cands:
-        if seen_recently(c["asin"]):
-            continue
+async def gather_candidates_async(concurrency: int = AMZ_CONCURRENCY) -> List[Dict]:
+    """
+    Come gather_candidates, ma cerca fino a `concurrency` keyword in parallelo.
+    Il ritmo delle chiamate resta governato dal rate limiter di amazon.py;
+    i risultati vengono uniti man mano che arrivano e una keyword che fallisce
+    non blocca le altre.
+    """
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def _search(kw: str) -> List[Dict]:
+        async with sem:
+            try:
+                items = await asyncio.to_thread(search_candidates_for_keyword, kw)
+            except Exception as e:
+                print(f"[selector] Keyword '{kw}' failed: {type(e).__name__}: {e}")
+                return []
+        for it in items:
+            it["tags"] = _keyword_tags(kw)
+        return items
+
+    all_items: List[Dict] = []
+    for fut in asyncio.as_completed([_search(kw) for kw in KEYWORDS]):
+        all_items.extend(await fut)
+
+    # AliExpress (se attivo e quando integrato)
+    all_items.extend(await asyncio.to_thread(fetch_aliexpress_candidates))
+    return merge_candidates(all_items)
+
+def _score(c: Dict, total_in_cat: Optional[int] = None) -> float:
+    # Punteggio BrislyDeals
+    return compute_brisly_score(
+        c.get("discount_pct", 0),
+        c.get("stars") or c.get("rating") or 4.0,
+        c["price_now"],
+        c.get("avg_90"),
+        rank=c.get("rank") or c.get("sales_rank"),
+        total_in_cat=total_in_cat or category_index.total_in_cat(c),
+        is_prime=c.get("prime", False),
+        buybox_amazon=c.get("buybox_amazon", False),
+        n_reviews=c.get("reviews") or c.get("review_count", 0),
+    )
+
+def _apply_keepa(c: Dict, k: Dict):
+    # category_name di PA-API è la categoria radice (serve a category_index):
+    # quella di Keepa è la foglia, si usa solo se PA-API non l'ha data
+    c.update({key: v for key, v in k.items() if key != "category_name"})
+    if not c.get("category_name") and k.get("category_name"):
+        c["category_name"] = k["category_name"]
+    # Se manca il "prezzo precedente" ma abbiamo la media 90g,
+    # stimiamo lo sconto rispetto ad avg_90
+    if not c.get("price_old") and c.get("avg_90"):
+        old = c["avg_90"]
+        if old and c.get("price_now") and old > c["price_now"]:
+            c["price_old"] = old
+            c["discount_pct"] = int(round((old - c["price_now"]) / old * 100))
+
+def _take_queued(queue: str, n: int, exclude: List[str]) -> List[str]:
+    """Fino a n ASIN dalla coda, esclusi quelli già pianificati o in cache (anche negativa)."""
+    if n <= 0:
+        return []
+    queued = [a for a in queue_pop(queue, n) if a not in exclude]
+    cached, blocked = lookup_cache(queued)
+    return [a for a in queued if a not in cached and a not in blocked]
+
+ENRICH_WAVE = 10  # massimo ASIN per richiesta Keepa nel ranker a flusso
+
+def _upper_bound(c: Dict) -> tuple:
+    """
+    Chiave di ordinamento massima che il candidato può raggiungere dopo
+    Keepa, dai soli dati PA-API: Keepa può solo aggiungere avg_90 (trend e
+    sconto stimato se manca price_old), Prime/Buy Box, rank e recensioni.
+    La categoria radice può arrivare da Keepa, quindi il rank vale sempre al
+    massimo.
+    """
+    if c.get("source") != "amazon":
+        return _score(c), c.get("discount_pct", 0)
+    opt = dict(c, avg_90=c["price_now"] * 2, prime=True, buybox_amazon=True)
+    if not c.get("price_old"):
+        opt["discount_pct"] = 100
+    if not (c.get("stars") or c.get("rating")):
+        opt["stars"] = 5.0
+    opt["rank"] = 1
+    if not (c.get("reviews") or c.get("review_count")):
+        opt["reviews"] = 10 ** 6
+    return _score(opt, total_in_cat=100), opt.get("discount_pct", 0)
+
+class TopK:
+    """
+    I k migliori candidati per (punteggio, sconto) in un min-heap; a parità
+    vince chi viene prima in `fresh`, come nell'ordinamento stabile completo.
+    Con k=None tiene tutto.
+    """
 
-        # Enrichment Keepa (solo Amazon, entro cap per token)
-        if c.get("source") == "amazon" and keepa_calls < KEEPA_MAX_ENRICH:
-            print(f"[selector] Enriching {c['asin']} with NEW Keepa client...")
-            k = enrich_with_keepa(c["asin"])  # Usa il nuovo client
-            if k:
-                c.update(k)
-                # Se manca il "prezzo precedente" ma abbiamo la media 90g,
-                # stimiamo lo sconto rispetto ad avg_90
-                if not c.get("price_old") and c.get("avg_90"):
-                    old = c["avg_90"]
-                    if old and c.get("price_now") and old > c["price_now"]:
-                        c["price_old"] = old
-                        c["discount_pct"] = int(round((old - c["price_now"]) / old * 100))
-                print(f"[selector] Keepa enriched {c['asin']} with data: {list(k.keys())}")
-            else:
-                print(f"[selector] No Keepa data for {c['asin']}")
-            keepa_calls += 1
-
-        # Filtro sconto minimo
-        if c.get("discount_pct", 0) < MIN_DISCOUNT:
+    def __init__(self, k: Optional[int]):
+        self.k = k
+        self._heap: List[tuple] = []
+
+    def beats(self, key: tuple, seq: int) -> bool:
+        if self.k is None or len(self._heap) < self.k:
+            return True
+        return (key[0], key[1], -seq) > self._heap[0][:3]
+
+    def push(self, c: Dict, seq: int):
+        entry = (c["score"], c.get("discount_pct", 0), -seq, c)
+        if self.k is None or len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry[:3] > self._heap[0][:3]:
+            heapq.heapreplace(self._heap, entry)
+
+    def ranked(self) -> List[Dict]:
+        return [e[3] for e in sorted(self._heap, key=lambda e: e[:3], reverse=True)]
+
+def _rank_one(top: TopK, c: Dict, seq: int, k: Optional[Dict]):
+    if k:
+        _apply_keepa(c, k)
+        print(f"[selector] Keepa enriched {c['asin']} with data: {list(k.keys())}")
+
+    # Filtro sconto minimo
+    if c.get("discount_pct", 0) < MIN_DISCOUNT:
+        return
+    c["score"] = _score(c)
+    top.push(c, seq)
+
+def enrich_and_rank(cands: List[Dict], k: Optional[int] = None) -> List[Dict]:
+    """
+    Arricchisce e ordina i candidati non pubblicati di recente; con `k`
+    restituisce solo i k migliori. I dati Keepa in cache (lettura bulk,
+    gratis) si usano subito; i mancanti vengono chiesti a Keepa a ondate, in
+    ordine di punteggio massimo raggiungibile (_upper_bound), e ci si ferma
+    appena nessuno può più superare il k-esimo in classifica. La prima ondata
+    è di k ASIN e raddoppia fino a ENRICH_WAVE: Keepa costa per ASIN, non per
+    richiesta, e così il limite pota prima di spendere i token. Le query reali
+    restano entro il budget token dello slot; gli ASIN non richiesti vanno
+    nella coda di prefetch. Gli ASIN rimandati li riprende prefetch_candidates,
+    così lo slot non aspetta Keepa per offerte che non pubblica.
+    """
+    seen = seen_recently_many(c["asin"] for c in cands)
+    fresh = [c for c in cands if c["asin"] not in seen]
+    top = TopK(k)
+
+    amazon = [c["asin"] for c in fresh if c.get("source") == "amazon"]
+    keepa_data, blocked = lookup_cache(amazon) if amazon else ({}, set())
+    misses: List[tuple] = []
+    for seq, c in enumerate(fresh):
+        if c.get("source") == "amazon" and c["asin"] not in keepa_data and c["asin"] not in blocked:
+            misses.append((_upper_bound(c), seq, c))
+        else:
+            _rank_one(top, c, seq, keepa_data.get(c["asin"]))
+    misses.sort(key=lambda m: (m[0][0], m[0][1], -m[1]), reverse=True)
+
+    allowance = slot_allowance(refresh_budget()) if misses else 0
+    fetched: List[str] = []
+    pending = list(misses)
+    skipped = 0
+    wave_size = min(k or ENRICH_WAVE, ENRICH_WAVE)
+    while pending and len(fetched) < allowance:
+        wave = []
+        while pending and len(wave) < min(wave_size, allowance - len(fetched)):
+            if not top.beats(pending[0][0], pending[0][1]):
+                # ordinati per upper bound: nessuno dei restanti può entrare
+                skipped, pending = len(pending), []
+                break
+            wave.append(pending.pop(0))
+        if not wave:
+            break
+        asins = [c["asin"] for _, _, c in wave]
+        data = fetch_many(asins, priorities={c["asin"]: _score(c) for _, _, c in misses})
+        fetched.extend(asins)
+        for _, seq, c in wave:
+            _rank_one(top, c, seq, data.get(c["asin"]))
+        wave_size = min(wave_size * 2, ENRICH_WAVE)
+
+    # Oltre il budget: punteggio senza Keepa, se possono ancora entrare
+    for ub, seq, c in pending:
+        if top.beats(ub, seq):
+            _rank_one(top, c, seq, None)
+        else:
+            skipped += 1
+
+    if fetched:
+        record_budget()
+    print(f"[selector] Keepa plan: {len(keepa_data)} cached, {len(fetched)}/{len(misses)} misses fetched, "
+          f"{skipped} skipped by bound (allowance {allowance})")
+    queue_prefetch({c["asin"]: _score(c) for _, _, c in misses if c["asin"] not in fetched})
+    return top.ranked()
+
+def prefetch_candidates(cands: List[Dict]) -> List[Dict]:
+    """
+    Modalità prefetch (ore fuori slot): scalda la cache Keepa per i candidati
+    più promettenti non ancora in cache, poi per gli ASIN rimandati e per
+    quelli in coda di prefetch, entro il budget token che non serve al
+    prossimo slot; rinnova anche l'indice categorie. Salva il pool di candidati
+    con il punteggio pre-Keepa per lo slot successivo.
+    """
+    seen = seen_recently_many(c["asin"] for c in cands)
+    fresh = [c for c in cands if c["asin"] not in seen]
+    for c in fresh:
+        c["prescore"] = _score(c)
+
+    amazon = [c for c in fresh if c.get("source") == "amazon"]
+    cached, blocked = lookup_cache([c["asin"] for c in amazon])
+    misses = sorted((c for c in amazon if c["asin"] not in cached and c["asin"] not in blocked),
+                    key=lambda c: (c["prescore"], c.get("discount_pct", 0)), reverse=True)
+    ranked = list(dict.fromkeys(c["asin"] for c in misses))
+
+    allowance = prefetch_allowance(refresh_budget())
+    if allowance > 0:
+        category_index.ensure_index()
+    to_fetch = ranked[:allowance]
+    to_fetch.extend(_take_queued(DEFER_QUEUE, allowance - len(to_fetch), to_fetch))
+    to_fetch.extend(_take_queued(PREFETCH_QUEUE, allowance - len(to_fetch), to_fetch))
+    print(f"[selector] Prefetch: {len(cached)} cached, fetching {len(to_fetch)} (allowance {allowance})")
+    if to_fetch:
+        fetch_many(to_fetch, priorities={c["asin"]: c["prescore"] for c in misses})
+        record_budget()
+    queue_prefetch({c["asin"]: c["prescore"] for c in misses if c["asin"] not in to_fetch})
+
+    cache_set(POOL_KEY, {"ts": int(time.time()), "items": fresh}, ttl_seconds=POOL_TTL_HOURS * 3600)
+    print(f"[selector] Saved candidate pool: {len(fresh)} items")
+    return fresh
+
+def refresh_offers(offers: List[Dict]) -> List[Dict]:
+    """
+    Prima di pubblicare: riallinea prezzo e sconto delle offerte Amazon con
+    una GetItems (ricerca e pool possono avere ore) e scarta quelle sotto
+    MIN_DISCOUNT o non più disponibili. Se PA-API non risponde per nessun
+    ASIN le offerte restano come sono.
+    """
+    asins = [o["asin"] for o in offers if o.get("source") == "amazon"]
+    fresh = {p["asin"]: p for p in refresh_items(asins)} if asins else {}
+    if asins and not fresh:
+        print("[selector] Price refresh failed: posting ranked offers as they are")
+        return offers
+
+    out = []
+    for o in offers:
+        if o.get("source") != "amazon":
+            out.append(o)
+            continue
+        p = fresh.get(o["asin"])
+        if p is None:
+            print(f"[selector] Dropping {o['asin']}: not available anymore")
+            continue
+        o["price_now"], o["price_old"], o["discount_pct"] = p["price_now"], p["price_old"], p["discount_pct"]
+        # senza prezzo di listino vale la stima da avg_90, come in _apply_keepa
+        if not o["price_old"] and o.get("avg_90") and o["avg_90"] > o["price_now"]:
+            o["price_old"] = o["avg_90"]
+            o["discount_pct"] = int(round((o["avg_90"] - o["price_now"]) / o["avg_90"] * 100))
+        if o["discount_pct"] < MIN_DISCOUNT:
+            print(f"[selector] Dropping {o['asin']}: discount now {o['discount_pct']}% < {MIN_DISCOUNT}%")
             continue
+        out.append(o)
+    return out
 
-        # Punteggio BrislyDeals
-        score = compute_brisly_score(
-            c.get("discount_pct", 0),
-            c.get("stars") or c.get("rating") or 4.0,
-            c["price_now"],
-            c.get("avg_90"),
-            rank=c.get("rank") or c.get("sales_rank"),
-            total_in_cat=None,
-            is_prime=c.get("prime", False),
-            buybox_amazon=c.get("buybox_amazon", False),
-            n_reviews=c.get("reviews") or c.get("review_count", 0),
-        )
-        c["score"] = score
-        enriched.append(c)
-
-    enriched.sort(key=lambda x: (x["score"], x.get("discount_pct", 0)), reverse=True)
-    return enriched
+def load_candidate_pool() -> Optional[List[Dict]]:
+    """Pool di candidati salvato dall'ultimo prefetch, se ancora valido."""
+    pool = cache_get(POOL_KEY)
+    if not pool or not pool.get("items"):
+        return None
+    print(f"[selector] Using prefetched pool: {len(pool['items'])} items, {int(time.time() - pool.get('ts', 0)) // 60} min old")
+    return pool["items"]
 
 def commit_published(asin: str):
     mark_dedup(asin)
@@ -1,13 +1,18 @@
 import urllib.parse
 
 async def task_publish():
-    cands = await asyncio.to_thread(gather_candidates)
-    ranked = await asyncio.to_thread(enrich_and_rank, cands)
+    # Pool salvato dal prefetch dell'ora precedente (cache Keepa già calda)
+    cands = load_candidate_pool() or await gather_candidates_async()
+    ranked = await asyncio.to_thread(enrich_and_rank, cands, POSTS_PER_SLOT)
     if not ranked:
         print("Nessuna offerta valida per questo slot.")
         return
 
-    to_post = ranked[:POSTS_PER_SLOT]
+    # Ricerca e pool possono avere ore: prezzi aggiornati con una GetItems
+    to_post = await asyncio.to_thread(refresh_offers, ranked[:POSTS_PER_SLOT])
+    if not to_post:
+        print("Nessuna offerta ancora valida dopo l'aggiornamento prezzi.")
+        return
     wk = week_key(datetime.now(TZ))
     await client.start(bot_token=BOT_TOKEN)
 
@@ -102,3 +107,9 @@ async def task_publish():
         commit_published(offer["asin"])
 
     await client.disconnect()
+
+async def task_prefetch():
+    """Ore fuori slot: cerca i candidati e scalda la cache Keepa per lo slot successivo."""
+    cands = await gather_candidates_async()
+    pool = await asyncio.to_thread(prefetch_candidates, cands)
+    print(f"Prefetch completato: {len(pool)} candidati pronti per il prossimo slot.")